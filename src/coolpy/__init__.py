@@ -0,0 +1,20 @@
+"""Cool things to do with Python.
+
+Submodules are imported on first use, so `import coolpy` is cheap and
+`coolpy.json` etc. work without importing them first.
+"""
+import importlib
+
+SUBMODULES = ('args', 'caching', 'coding', 'fetch', 'json', 'jsondb', 'merge', 'tui', 'wikipedia')
+
+__all__ = list(SUBMODULES)
+
+
+def __getattr__(name: str):
+    if name in SUBMODULES:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(SUBMODULES))
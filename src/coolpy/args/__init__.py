@@ -1,5 +1,7 @@
 import typing as t
 import argparse
+import functools
+import importlib
 import os
 import sys
 from dataclasses import dataclass
@@ -16,16 +18,33 @@ class Arg:
     choices: list[any] = None
 
 
+class Command:
+    """Base class of the subcommands declared inside an arguments class.
+
+    Other nested classes, such as an Enum used for choices, are left alone.
+    """
+
+
 T = t.TypeVar('T')
 
 
-def parse_args(args: type[T], prog: str=os.path.basename(sys.argv[0]), description: str=None) -> T:
+def parse_args(args: type[T], prog: str=os.path.basename(sys.argv[0]), description: str=None,
+               subcommands: t.Mapping[str, type | str] | None=None, argv: list[str] | None=None) -> T:
     """Parse command-line arguments using a class with type hints for each argument.
 
+    Subcommands are declared as Command subclasses nested in `args`, or in `subcommands` as
+    a module path like 'mytools.build', whose `Args` class defines the command's
+    arguments ('mytools.build:BuildArgs' names another class). Only the module of
+    the command that is run gets imported. The parsed result then also has
+    `command` (its name), `command_args` (its parsed arguments) and `command_main`
+    (the module's or class's `main` function, or None).
+
     Args:
         args (T): A class object (NOT a class instance) with a type-hinted attribute for each argument, and optional Arg metadata. 
         prog (str, optional): The name of the program. Defaults to os.path.basename(sys.argv[0]).
         description (str, optional): A brief description of the program. Defaults to None.
+        subcommands (Mapping[str, type | str], optional): Subcommand classes or module paths by name.
+        argv (list[str], optional): The arguments to parse. Defaults to sys.argv[1:].
 
     Returns:
         T: An instance of the class with the parsed arguments.
@@ -35,12 +54,60 @@ def parse_args(args: type[T], prog: str=os.path.basename(sys.argv[0]), descripti
 
     parser = argparse.ArgumentParser(prog=prog, description=description)
 
+    for function_args, function_kwargs, default_factory in parser_spec(args):
+        function_kwargs = dict(function_kwargs)
+        if default_factory is not None:
+            function_kwargs['default'] = default_factory()
+            function_kwargs['help'] = (function_kwargs.get('help', '') +
+                                      f' (default: {function_kwargs["default"]})').strip()
+        parser.add_argument(*function_args, **function_kwargs)
+
+    commands = {**nested_commands(args), **(subcommands or {})}
+    if len(commands) == 0:
+        return parser.parse_args(argv)
+
+    # Placeholder parsers list the commands; the chosen one's arguments are parsed by its own parser
+    command_parsers = parser.add_subparsers(dest='command', metavar='command', required=True)
+    for name, command in commands.items():
+        command_help = command.__doc__.strip().splitlines()[0] if not isinstance(command, str) and command.__doc__ else None
+        command_parsers.add_parser(name, help=command_help, add_help=False)
+
+    parsed_args, command_argv = parser.parse_known_args(argv)
+    command = commands[parsed_args.command]
+    command_class, command_main = load_command(command)
+    parsed_args.command_args = parse_args(command_class, prog=f'{prog} {parsed_args.command}', argv=command_argv)
+    parsed_args.command_main = command_main
+    return parsed_args
+
+
+def nested_commands(args: type) -> dict[str, type]:
+    """Command classes declared inside an arguments class, which are its subcommands."""
+    return {name: value for name, value in vars(args).items()
+            if isinstance(value, type) and issubclass(value, Command) and not name.startswith('_')}
+
+
+def load_command(command: type | str) -> tuple[type, t.Callable | None]:
+    """The arguments class of a subcommand and its main function, importing its module if needed."""
+    if isinstance(command, type):
+        return command, getattr(command, 'main', None)
+
+    module_path, _, class_name = command.partition(':')
+    module = importlib.import_module(module_path)
+    return getattr(module, class_name or 'Args'), getattr(module, 'main', None)
+
+
+@functools.cache
+def parser_spec(args: type) -> tuple[tuple[list[str], dict[str, any], t.Callable[[], any] | None], ...]:
+    """(flags, add_argument kwargs, default_factory) for each argument, built once per class."""
+    spec = []
+
     for arg_name, ArgType in t.get_type_hints(args).items():
         arg: Arg = getattr(args, arg_name, None)
 
         optional = False
         function_args = []
         function_kwargs = {}
+        default_factory = None
 
         if arg is not None:
             if arg.default is not None:
@@ -49,17 +116,18 @@ def parse_args(args: type[T], prog: str=os.path.basename(sys.argv[0]), descripti
             if arg.help is not None:
                 function_kwargs['help'] = arg.help
             if arg.default_factory is not None:
-                function_kwargs['default'] = arg.default_factory()
+                # Called for every parse, so parses don't share a mutable default
+                default_factory = arg.default_factory
                 optional = True
             if arg.nargs is not None:
                 function_kwargs['nargs'] = arg.nargs
             if arg.choices is not None:
                 function_kwargs['choices'] = arg.choices
             if arg.flags is not None:
-                function_args = arg.flags
+                function_args = list(arg.flags)
                 optional = True
 
-        if 'default' in function_kwargs:
+        if 'default' in function_kwargs and default_factory is None:
             function_kwargs['help'] = (function_kwargs.get('help', '') +
                                       f' (default: {function_kwargs["default"]})').strip()
 
@@ -79,7 +147,6 @@ def parse_args(args: type[T], prog: str=os.path.basename(sys.argv[0]), descripti
             else:
                 function_kwargs['type'] = ArgType
 
-        parser.add_argument(*function_args, **function_kwargs)
+        spec.append((function_args, function_kwargs, default_factory))
 
-    args = parser.parse_args()
-    return args
+    return tuple(spec)
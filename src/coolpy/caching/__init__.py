@@ -1,2 +1,23 @@
+import importlib
+import types
+from .memory_cache import *
+from .cache_store import *
+from .cache import *
+from .cache_key import *
+from .rate_limit import *
+from .fingerprint import *
 from .cached_function import *
-from .cached_requests import *
+
+# cached_requests needs requests, which is slow to import, so its names are only loaded when used.
+# These are its __all__.
+_lazy_names = ('CachedRequests', 'CachedResponse', 'CACHED_HEADERS', 'CACHE_NAME', 'USER_AGENT',
+               'as_response', 'get_session', 'request_headers', 'session', 'session_request')
+
+__all__ = [name for name, value in globals().items()
+           if not name.startswith('_') and not isinstance(value, types.ModuleType)] + list(_lazy_names)
+
+
+def __getattr__(name: str):
+    if name in _lazy_names:
+        return getattr(importlib.import_module(f'{__name__}.cached_requests'), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
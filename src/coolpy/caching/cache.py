@@ -0,0 +1,271 @@
+from typing import *
+import pickle
+import time
+import logging
+from .cache_store import CacheStore
+from .cache_key import cache_key
+
+log = logging.getLogger('cache')
+
+
+SELECT_SQL = 'select return_value, storage, size, timestamp from cache where key = ?'
+TIMESTAMP_SQL = 'select timestamp from cache where key = ?'
+INSERT_SQL = '''insert into cache (key, args, kwargs, return_value, storage, body, size, timestamp, accessed) values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    on conflict(key) do update set args = excluded.args, kwargs = excluded.kwargs, return_value = excluded.return_value,
+    storage = excluded.storage, body = excluded.body, size = excluded.size, timestamp = excluded.timestamp, accessed = excluded.accessed'''
+DELETE_SQL = 'delete from cache where key = ?'
+
+# Keys per query in fresh_keys, well under SQLite's limit on bound parameters
+KEY_BATCH = 10000
+
+
+class CacheResult(NamedTuple):
+    """The outcome of a cache lookup.
+
+    `value` is set on a hit, and also on a miss when a stale value was asked
+    for and found (`stale` is then True). `age` is in seconds and `size` is
+    the stored size in bytes, both None when nothing was found.
+    """
+    value: Any
+    hit: bool
+    stale: bool = False
+    age: float | None = None
+    size: int | None = None
+
+
+MISS = CacheResult(None, False)
+
+
+class Cache:
+    """A named cache of pickled values, keyed by fixed-size digests.
+
+    This is the layer the decorators and CachedRequests are built on: a
+    single `lookup` returns the value together with hit, age and size
+    metadata, so callers never have to query the cache twice.
+
+    Entries are fresh for `days`; with `days=None` they never expire by age.
+    Expired entries are deleted after `keep_days` if given.
+    """
+    name: str
+    seconds: int | None
+    backend: CacheStore
+    stampede: str | None
+    lease_seconds: float
+    lease_timeout: float
+
+    def __init__(self, name: str, days: float | None=28.0, memory_entries: int=0, memory_bytes: int=64 * 1024 * 1024,
+                 stampede: Literal['wait', 'stale'] | None=None, lease_seconds: float=60.0, lease_timeout: float=30.0,
+                 max_bytes: int | None=None, max_entries: int | None=None,
+                 compress_threshold: int | None=None, file_threshold: int | None=None, keep_days: float | None=None):
+        self.name = name
+        self.seconds = int(days * 24 * 60 * 60) if days is not None else None
+        self.stampede = stampede
+        self.lease_seconds = lease_seconds
+        self.lease_timeout = lease_timeout
+
+        # Expired rows are deleted a few at a time as the cache is written, stale
+        # mode keeps them for one more expiry period so they can still be served
+        if keep_days is not None:
+            expire_seconds = int(keep_days * 24 * 60 * 60)
+        elif self.seconds is None:
+            expire_seconds = None
+        else:
+            expire_seconds = self.seconds * 2 if stampede == 'stale' else self.seconds
+
+        self.backend = CacheStore.get(name)
+        self.backend.set_limits(expire_seconds=expire_seconds, max_bytes=max_bytes, max_entries=max_entries)
+        self.backend.set_storage(compress_threshold=compress_threshold, file_threshold=file_threshold)
+
+        if memory_entries > 0:
+            self.backend.enable_memory(memory_entries, memory_bytes)
+
+
+    @staticmethod
+    def key(args: tuple, kwargs: dict) -> bytes:
+        return cache_key(args, kwargs)
+
+
+    def lookup_memory(self, key: bytes) -> CacheResult:
+        """Look a key up in the in-memory tier only."""
+        memory = self.backend.memory
+        if memory is None:
+            return MISS
+
+        entry = memory.get(key)
+        if entry is None:
+            return MISS
+
+        value, timestamp, size = entry
+        now = time.time()
+        if self.fresh(timestamp, now):
+            log.debug('Memory cache hit!')
+            self.backend.touch(key, int(now))
+            return CacheResult(value, True, False, now - timestamp, size)
+
+        memory.discard(key)
+        return MISS
+
+
+    def lookup(self, key: bytes, allow_stale: bool=False) -> CacheResult:
+        """Look a key up in memory, then in SQLite.
+
+        With `allow_stale`, an expired value is returned as a miss with `stale` set.
+        """
+        result = self.lookup_memory(key)
+        if result.hit:
+            return result
+
+        row = self.backend.fetchone(SELECT_SQL, (key, ))
+        if row is None:
+            log.debug('Cache miss')
+            return MISS
+
+        stored_value, storage, size, timestamp = row
+        now = time.time()
+        fresh = self.fresh(timestamp, now)
+
+        if not fresh and not allow_stale:
+            log.debug(f'Too old: {timestamp} < {int(now)} - {self.seconds}')
+            return MISS
+
+        try:
+            value, pickled_size = self.backend.decode_sized(storage, stored_value)
+        except FileNotFoundError:
+            log.debug('Cache miss: blob file is gone')
+            return MISS
+
+        if not fresh:
+            return CacheResult(value, False, True, now - timestamp, size)
+
+        log.debug('Cache hit!')
+        self.backend.touch(key, int(now))
+        if self.backend.memory is not None:
+            self.backend.memory.put(key, value, timestamp, pickled_size)
+        return CacheResult(value, True, False, now - timestamp, size)
+
+
+    def contains(self, key: bytes) -> bool:
+        """Whether a fresh entry exists, without loading its value."""
+        if self.lookup_memory(key).hit:
+            return True
+
+        row = self.backend.fetchone(TIMESTAMP_SQL, (key, ))
+        return row is not None and self.fresh(row[0], time.time())
+
+
+    def fresh(self, timestamp: int, now: float) -> bool:
+        return self.seconds is None or timestamp > int(now) - self.seconds
+
+
+    def store(self, key: bytes, value: Any, args: tuple=(), kwargs: dict={}, commit: bool=False, body: str | None=None) -> CacheResult:
+        """Store a value. args and kwargs are only kept for debugging.
+
+        `body` is the digest of a blob file written with `backend.write_blob`
+        that belongs to this entry: it counts towards the entry's size and is
+        deleted along with it.
+        """
+        row, pickled_size = self.row(key, value, args, kwargs, body)
+        self.backend.write(INSERT_SQL, row, commit=commit)
+        if self.backend.memory is not None:
+            self.backend.memory.put(key, value, row[-1], pickled_size)
+        return CacheResult(value, False, False, 0.0, row[-3])
+
+
+    def store_many(self, entries: Iterable[tuple[bytes, Any, tuple, dict]], commit: bool=True) -> int:
+        """Store (key, value, args, kwargs) entries in a single transaction. Returns the number stored."""
+        rows = []
+        for key, value, args, kwargs in entries:
+            row, pickled_size = self.row(key, value, args, kwargs)
+            rows.append(row)
+            if self.backend.memory is not None:
+                self.backend.memory.put(key, value, row[-1], pickled_size)
+
+        if len(rows) > 0:
+            self.backend.write_many(INSERT_SQL, rows, commit=commit)
+        return len(rows)
+
+
+    def row(self, key: bytes, value: Any, args: tuple, kwargs: dict, body: str | None=None) -> tuple[tuple, int]:
+        """The INSERT_SQL parameters for an entry, and the size of its pickled value."""
+        now_timestamp = int(time.time())
+        pickled_value = pickle.dumps(value)
+        storage, stored_value, stored_size = self.backend.encode_value(pickled_value)
+        pickled_args = pickle.dumps(args)
+        pickled_kwargs = pickle.dumps(kwargs)
+        size = len(key) + len(pickled_args) + len(pickled_kwargs) + stored_size
+        if body is not None:
+            size += self.backend.blob_size(body)
+        row = (key, pickled_args, pickled_kwargs, stored_value, storage, body.encode() if body is not None else None,
+               size, now_timestamp, now_timestamp)
+        return row, len(pickled_value)
+
+
+    def fresh_keys(self, keys: Iterable[bytes]) -> set[bytes]:
+        """The subset of keys that have fresh entries, found with one query per KEY_BATCH keys."""
+        keys = list(keys)
+        fresh = set()
+        cutoff = (' and timestamp > ?', [int(time.time()) - self.seconds]) if self.seconds is not None else ('', [])
+
+        for start in range(0, len(keys), KEY_BATCH):
+            batch = keys[start:start + KEY_BATCH]
+            sql = f'select key from cache where key in ({",".join("?" * len(batch))}){cutoff[0]}'
+            fresh.update(row[0] for row in self.backend.fetchall(sql, batch + cutoff[1]))
+
+        return fresh
+
+
+    def invalidate(self, key: bytes):
+        if self.backend.memory is not None:
+            self.backend.memory.discard(key)
+        self.backend.write(DELETE_SQL, (key, ))
+
+
+    def get_or_compute(self, key: bytes, compute: Callable[[], Any], args: tuple=(), kwargs: dict={}) -> CacheResult:
+        """Return the cached value for a key, computing and storing it on a miss."""
+        result = self.lookup(key)
+        if result.hit:
+            return result
+
+        if self.stampede is not None:
+            return self.compute_with_lease(key, compute, args, kwargs)
+
+        return self.store(key, compute(), args, kwargs)
+
+
+    def compute_with_lease(self, key: bytes, compute: Callable[[], Any], args: tuple=(), kwargs: dict={}) -> CacheResult:
+        """Compute a missing entry while holding its cross-process lease.
+
+        Processes that don't get the lease poll for the value until
+        `lease_timeout` runs out, then compute it themselves. With
+        `stampede='stale'` they return the expired value instead of waiting.
+        """
+        deadline = time.monotonic() + self.lease_timeout
+        delay = 0.05
+
+        while True:
+            if self.backend.acquire_lease(key, self.lease_seconds):
+                try:
+                    # The previous holder may have stored it while we were waiting
+                    result = self.lookup(key)
+                    if result.hit:
+                        return result
+
+                    return self.store(key, compute(), args, kwargs, commit=True)
+                finally:
+                    self.backend.release_lease(key)
+
+            if self.stampede == 'stale':
+                result = self.lookup(key, allow_stale=True)
+                if result.hit or result.stale:
+                    return result
+
+            if time.monotonic() > deadline:
+                log.warning(f'Timed out waiting for the lease on {self.name}, computing anyway')
+                return self.store(key, compute(), args, kwargs, commit=True)
+
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+            result = self.lookup(key)
+            if result.hit:
+                return result
@@ -0,0 +1,115 @@
+from typing import *
+import dataclasses
+import hashlib
+import pickle
+import types
+
+KEY_SIZE = 16
+
+
+def _canonical(obj: Any, out: bytearray, parents: dict[int, int]):
+    t = type(obj)
+
+    if obj is None:
+        out += b'N'
+    elif t is bool:
+        out += b'T' if obj else b'F'
+    elif t is int:
+        out += b'i%d;' % obj
+    elif t is float:
+        out += b'f' + obj.hex().encode() + b';'
+    elif t is str:
+        data = obj.encode('utf-8', 'surrogatepass')
+        out += b's%d:' % len(data)
+        out += data
+    elif t is bytes or t is bytearray:
+        out += b'b%d:' % len(obj)
+        out += obj
+    elif id(obj) in parents:
+        # A container inside itself refers back to it by depth
+        out += b'@%d;' % parents[id(obj)]
+    elif t is tuple or t is list:
+        parents[id(obj)] = len(parents)
+        out += b'(' if t is tuple else b'['
+        for item in obj:
+            _canonical(item, out, parents)
+        out += b')' if t is tuple else b']'
+        del parents[id(obj)]
+    elif t is dict:
+        parents[id(obj)] = len(parents)
+        # Order-independent: sort entries by their canonical key encoding
+        items = []
+        for key, value in obj.items():
+            key_bytes = bytearray()
+            _canonical(key, key_bytes, parents)
+            value_bytes = bytearray()
+            _canonical(value, value_bytes, parents)
+            items.append((bytes(key_bytes), bytes(value_bytes)))
+        out += b'{'
+        for key_bytes, value_bytes in sorted(items):
+            out += key_bytes
+            out += value_bytes
+        out += b'}'
+        del parents[id(obj)]
+    elif t is set or t is frozenset:
+        items = []
+        for item in obj:
+            item_bytes = bytearray()
+            _canonical(item, item_bytes, parents)
+            items.append(bytes(item_bytes))
+        out += b'<'
+        for item_bytes in sorted(items):
+            out += item_bytes
+        out += b'>'
+    elif _is_global(obj):
+        out += b'r' + f'{obj.__module__}.{obj.__qualname__}'.encode() + b';'
+    elif _is_data(obj):
+        parents[id(obj)] = len(parents)
+        out += b'o' + f'{t.__module__}.{t.__qualname__}'.encode() + b';'
+        if dataclasses.is_dataclass(obj):
+            fields = {field.name: getattr(obj, field.name) for field in dataclasses.fields(obj)}
+        else:
+            fields = vars(obj)
+        _canonical(fields, out, parents)
+        del parents[id(obj)]
+    else:
+        # Pickle raises for what it can't identify either, like lambdas and local functions
+        data = pickle.dumps(obj)
+        out += b'p%d:' % len(data)
+        out += data
+
+
+def _is_global(obj: Any) -> bool:
+    """Whether obj is a class or function that its module and qualified name identify."""
+    if isinstance(obj, types.BuiltinFunctionType):
+        # Builtin methods like [].append are bound to an instance
+        if not (obj.__self__ is None or isinstance(obj.__self__, types.ModuleType)):
+            return False
+    elif not isinstance(obj, (type, types.FunctionType)):
+        return False
+    return '<' not in obj.__qualname__
+
+
+def _is_data(obj: Any) -> bool:
+    """Whether obj is a plain data object, identified by its type and fields."""
+    if isinstance(obj, type) or callable(obj):
+        return False
+    return dataclasses.is_dataclass(obj) or hasattr(obj, '__dict__')
+
+
+def canonical_bytes(obj: Any) -> bytes:
+    """Serialize an object so that logically equal values give equal bytes.
+
+    Dicts and sets are encoded independently of their iteration order.
+    """
+    out = bytearray()
+    _canonical(obj, out, {})
+    return bytes(out)
+
+
+def cache_key(args: tuple, kwargs: dict) -> bytes:
+    """Fixed-size digest identifying a call with the given arguments."""
+    out = bytearray()
+    _canonical(args, out, {})
+    _canonical(kwargs, out, {})
+    return hashlib.blake2b(out, digest_size=KEY_SIZE).digest()
@@ -0,0 +1,483 @@
+from typing import *
+import atexit
+import os
+import sqlite3
+import threading
+import socket
+import time
+import logging
+import hashlib
+import io
+import mmap
+import pickle
+import zlib
+from .memory_cache import MemoryCache
+
+log = logging.getLogger('cache_store')
+
+SCHEMA_VERSION = 4
+
+# How a return value is stored in the return_value column
+STORAGE_INLINE = 0      # pickle
+STORAGE_COMPRESSED = 1  # zlib-compressed pickle
+STORAGE_FILE = 2        # digest of a pickle file in the blob directory
+
+
+class CacheStore:
+    """A pooled SQLite connection for one cache name.
+
+    There is one store per cache name per process, shared by every thread.
+    The schema is created once when the store is opened, the database runs
+    in WAL mode, and writes are grouped into small transactions: they are
+    committed when `commit_every` writes are pending, `commit_interval`
+    seconds after the first pending write, or at interpreter exit.
+
+    Each commit also does a little maintenance: it records the access times
+    of recent hits, deletes up to `expire_batch` expired rows, and evicts
+    least recently used rows while the cache is over `max_bytes` or
+    `max_entries`. Entry and byte totals are kept up to date by triggers,
+    so none of this scans the whole cache.
+
+    Return values larger than `compress_threshold` are stored compressed,
+    and values larger than `file_threshold` are written to content-addressed
+    files in a directory next to the database and read back through a memory
+    map, so big blobs never pass through SQLite. Rows can also reference a
+    raw body file in the same directory (the `body` column), written in
+    chunks by `write_blob` and opened with `open_blob`.
+    """
+    name: str
+    path: str
+    blob_dir: str
+    conn: sqlite3.Connection
+    lock: threading.RLock
+    timer_lock: threading.Lock
+    pid: int
+
+    commit_every: int = 32
+    commit_interval: float = 1.0
+
+    pending_writes: int
+    commit_timer: threading.Timer | None
+
+    memory: MemoryCache | None = None
+
+    expire_seconds: int | None = None
+    expire_batch: int = 100
+    max_bytes: int | None = None
+    max_entries: int | None = None
+    touched: dict[bytes, int]
+
+    compress_threshold: int | None = None
+    file_threshold: int | None = None
+
+    _registry: dict[str, 'CacheStore'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, name: str):
+        self.name = name
+        self.path = os.path.expanduser(f'~/.cache/{name}-cache.sqlite')
+        self.blob_dir = os.path.expanduser(f'~/.cache/{name}-cache.blobs')
+        self.lock = threading.RLock()
+        self.timer_lock = threading.Lock()
+        self.pending_writes = 0
+        self.commit_timer = None
+        self.touched = {}
+        self.connect()
+
+
+    @classmethod
+    def get(cls, name: str) -> 'CacheStore':
+        """Get the shared store for a cache name, opening it on first use."""
+        store = cls._registry.get(name)
+        if store is not None:
+            return store
+
+        with cls._registry_lock:
+            store = cls._registry.get(name)
+            if store is None:
+                store = cls._registry[name] = cls(name)
+            return store
+
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.pid = os.getpid()
+        self.pending_writes = 0
+        self.commit_timer = None
+        self.touched = {}
+        self.conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False, cached_statements=256)
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('pragma synchronous=normal')
+        self.create_schema()
+        self.conn.commit()
+
+
+    def enable_memory(self, max_entries: int, max_bytes: int) -> MemoryCache:
+        """Put an in-process LRU tier in front of this store.
+
+        When several decorators share a cache name the largest limits win.
+        """
+        with self.lock:
+            if self.memory is None:
+                self.memory = MemoryCache(max_entries, max_bytes)
+            else:
+                self.memory.max_entries = max(self.memory.max_entries, max_entries)
+                self.memory.max_bytes = max(self.memory.max_bytes, max_bytes)
+            return self.memory
+
+
+    def set_limits(self, expire_seconds: int | None = None, max_bytes: int | None = None, max_entries: int | None = None):
+        """Configure incremental expiry and size limits.
+
+        When several decorators share a cache name, rows are kept for the
+        longest expiry window and the smallest size limits win.
+        """
+        with self.lock:
+            if expire_seconds is not None:
+                self.expire_seconds = max(self.expire_seconds or 0, expire_seconds)
+            if max_bytes is not None:
+                self.max_bytes = min(self.max_bytes or max_bytes, max_bytes)
+            if max_entries is not None:
+                self.max_entries = min(self.max_entries or max_entries, max_entries)
+
+
+    def set_storage(self, compress_threshold: int | None = None, file_threshold: int | None = None):
+        """Configure compressed and out-of-line storage. The smallest thresholds win."""
+        with self.lock:
+            if compress_threshold is not None:
+                self.compress_threshold = min(self.compress_threshold or compress_threshold, compress_threshold)
+            if file_threshold is not None:
+                self.file_threshold = min(self.file_threshold or file_threshold, file_threshold)
+
+
+    def encode_value(self, pickled_value: bytes) -> tuple[int, bytes, int]:
+        """Choose how to store a pickled value. Returns (storage, column value, stored size)."""
+        size = len(pickled_value)
+
+        if self.file_threshold is not None and size > self.file_threshold:
+            digest, _ = self.write_blob([pickled_value])
+            return STORAGE_FILE, digest.encode(), size
+
+        if self.compress_threshold is not None and size > self.compress_threshold:
+            compressed = zlib.compress(pickled_value)
+            if len(compressed) < size:
+                return STORAGE_COMPRESSED, compressed, len(compressed)
+
+        return STORAGE_INLINE, pickled_value, size
+
+
+    def decode_value(self, storage: int, data: bytes) -> Any:
+        """Unpickle a stored value. Raises FileNotFoundError if its blob file is gone."""
+        return self.decode_sized(storage, data)[0]
+
+
+    def decode_sized(self, storage: int, data: bytes) -> tuple[Any, int]:
+        """decode_value, also returning the size of the pickled value, which the memory tier counts."""
+        if storage == STORAGE_INLINE:
+            return pickle.loads(data), len(data)
+
+        if storage == STORAGE_COMPRESSED:
+            pickled_value = zlib.decompress(data)
+            return pickle.loads(pickled_value), len(pickled_value)
+
+        with open(self.blob_path(data.decode()), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return pickle.loads(mapped), len(mapped)
+
+
+    def write_blob(self, chunks: Iterable[bytes]) -> tuple[str, int]:
+        """Write chunks to a content-addressed file without holding them all in memory.
+
+        Returns the file's digest and size.
+        """
+        os.makedirs(self.blob_dir, exist_ok=True)
+        temp_path = os.path.join(self.blob_dir, f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        hasher = hashlib.blake2b(digest_size=20)
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        digest = hasher.hexdigest()
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return digest, size
+
+
+    def open_blob(self, digest: str) -> mmap.mmap | io.BytesIO:
+        """A read-only, file-like memory map of a blob file. Raises FileNotFoundError if it is gone."""
+        with open(self.blob_path(digest), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                return io.BytesIO()
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def blob_size(self, digest: str) -> int:
+        return os.path.getsize(self.blob_path(digest))
+
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+
+    def create_schema(self):
+        version = self.conn.execute('pragma user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            # It's only a cache, so older layouts are dropped rather than migrated
+            log.info(f'Recreating cache {self.path} (schema version {version} -> {SCHEMA_VERSION})')
+            self.conn.execute('drop table if exists cache')
+            self.conn.execute('drop table if exists cache_stats')
+            self.conn.execute('drop table if exists blob_garbage')
+            self.conn.execute('drop table if exists lease')
+
+        # args and kwargs are only kept for debugging, rows are looked up by key
+        self.conn.execute('create table if not exists cache (key blob primary key, args blob, kwargs blob, return_value blob, storage integer, body blob, size integer, timestamp integer, accessed integer)')
+        self.conn.execute('create index if not exists cache_timestamp on cache(timestamp)')
+        self.conn.execute('create index if not exists cache_accessed on cache(accessed)')
+
+        # Running totals, so size limits can be checked without scanning the cache
+        self.conn.execute('create table if not exists cache_stats (entries integer, bytes integer)')
+        self.conn.execute('insert into cache_stats (entries, bytes) select 0, 0 where not exists (select 1 from cache_stats)')
+        self.conn.execute('create trigger if not exists cache_stats_insert after insert on cache begin update cache_stats set entries = entries + 1, bytes = bytes + new.size; end')
+        self.conn.execute('create trigger if not exists cache_stats_delete after delete on cache begin update cache_stats set entries = entries - 1, bytes = bytes - old.size; end')
+        self.conn.execute('create trigger if not exists cache_stats_update after update of size on cache begin update cache_stats set bytes = bytes - old.size + new.size; end')
+
+        # Blob files that may have lost their last row, removed on the next commit
+        self.conn.execute(f'create index if not exists cache_blob on cache(return_value) where storage = {STORAGE_FILE}')
+        self.conn.execute('create table if not exists blob_garbage (digest blob)')
+        self.conn.execute(f'create trigger if not exists blob_garbage_delete after delete on cache when old.storage = {STORAGE_FILE} begin insert into blob_garbage values (old.return_value); end')
+        self.conn.execute(f'create trigger if not exists blob_garbage_update after update of return_value on cache when old.storage = {STORAGE_FILE} and new.return_value is not old.return_value begin insert into blob_garbage values (old.return_value); end')
+        self.conn.execute('create index if not exists cache_body on cache(body) where body is not null')
+        self.conn.execute('create trigger if not exists body_garbage_delete after delete on cache when old.body is not null begin insert into blob_garbage values (old.body); end')
+        self.conn.execute('create trigger if not exists body_garbage_update after update of body on cache when old.body is not null and new.body is not old.body begin insert into blob_garbage values (old.body); end')
+
+        # Cross-process leases: the holder of a key's lease computes it, everyone else waits
+        self.conn.execute('create table if not exists lease (key blob primary key, owner text, host text, pid integer, expires real)')
+        self.conn.execute(f'pragma user_version = {SCHEMA_VERSION}')
+
+
+    def check_fork(self):
+        # SQLite connections must not be shared with a forked child process
+        if self.pid != os.getpid():
+            self.lock = threading.RLock()
+            self.timer_lock = threading.Lock()
+            self.connect()
+
+
+    def fetchone(self, sql: str, parameters: Sequence = ()) -> tuple | None:
+        self.check_fork()
+        with self.lock:
+            return self.conn.execute(sql, parameters).fetchone()
+
+
+    def fetchall(self, sql: str, parameters: Sequence = ()) -> list[tuple]:
+        self.check_fork()
+        with self.lock:
+            return self.conn.execute(sql, parameters).fetchall()
+
+
+    def write(self, sql: str, parameters: Sequence = (), commit: bool = False) -> int:
+        """Execute a write inside the current batch. Returns the number of rows changed.
+
+        Pass `commit=True` when other processes must see the write right away.
+        """
+        self.check_fork()
+        with self.lock:
+            cursor = self.conn.execute(sql, parameters)
+            self.pending_writes += 1
+
+            if commit or self.pending_writes >= self.commit_every:
+                self.flush()
+            else:
+                self.schedule_flush()
+
+            return cursor.rowcount
+
+
+    def write_many(self, sql: str, rows: Iterable[Sequence], commit: bool = True) -> int:
+        """Execute a write for every row in one statement of the current batch. Returns the number of rows changed."""
+        self.check_fork()
+        with self.lock:
+            cursor = self.conn.executemany(sql, rows)
+            self.pending_writes += 1
+
+            if commit or self.pending_writes >= self.commit_every:
+                self.flush()
+            else:
+                self.schedule_flush()
+
+            return cursor.rowcount
+
+
+    def touch(self, key: bytes, timestamp: int):
+        """Record a hit. Access times are written with the next commit.
+
+        This doesn't take the store lock, which is held during commits and
+        lease waits, so memory-tier hits never wait for SQLite.
+        """
+        self.check_fork()
+        self.touched[key] = timestamp
+        self.schedule_flush()
+
+
+    def schedule_flush(self):
+        with self.timer_lock:
+            if self.commit_timer is None:
+                self.commit_timer = threading.Timer(self.commit_interval, self.flush)
+                self.commit_timer.daemon = True
+                self.commit_timer.start()
+
+
+    def flush(self):
+        """Commit any pending writes."""
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+
+            with self.timer_lock:
+                if self.commit_timer is not None:
+                    self.commit_timer.cancel()
+                    self.commit_timer = None
+
+            if self.pending_writes == 0 and len(self.touched) == 0:
+                return
+
+            log.debug(f'Committing {self.pending_writes} writes to {self.path}')
+            self.maintain()
+            self.conn.commit()
+            self.pending_writes = 0
+
+
+    def maintain(self):
+        """Bounded housekeeping, run inside the transaction being committed."""
+        if len(self.touched) > 0:
+            # Swapped out first, as touch adds to it without the lock. A hit recorded in
+            # the old dict after this only loses that access time.
+            touched, self.touched = self.touched, {}
+            self.conn.executemany('update cache set accessed = ? where key = ?', [(timestamp, key) for key, timestamp in list(touched.items())])
+
+        if self.expire_seconds is not None:
+            cutoff = int(time.time()) - self.expire_seconds
+            self.delete_keys('select key from cache where timestamp < ? limit ?', (cutoff, self.expire_batch))
+
+        self.collect_blobs()
+
+        if self.max_bytes is None and self.max_entries is None:
+            return
+
+        while True:
+            entries, total_bytes = self.conn.execute('select entries, bytes from cache_stats').fetchone()
+            over_entries = self.max_entries is not None and entries > self.max_entries
+            over_bytes = self.max_bytes is not None and total_bytes > self.max_bytes
+            if not (over_entries or over_bytes):
+                return
+
+            batch = min(entries - self.max_entries, 1000) if over_entries else 16
+            log.debug(f'Cache {self.name} holds {entries} entries, {total_bytes} bytes: evicting {batch}')
+            if self.delete_keys('select key from cache order by accessed limit ?', (batch, )) == 0:
+                return
+            self.collect_blobs()
+
+
+    def collect_blobs(self):
+        """Delete blob files no longer referenced by any row."""
+        digests = {row[0] for row in self.conn.execute('select digest from blob_garbage').fetchall()}
+        if len(digests) == 0:
+            return
+
+        for digest in digests:
+            row = self.conn.execute(f'select 1 from cache where (storage = {STORAGE_FILE} and return_value = ?) or body = ? limit 1', (digest, digest)).fetchone()
+            if row is not None:
+                continue
+            try:
+                os.remove(self.blob_path(digest.decode()))
+            except FileNotFoundError:
+                pass
+
+        self.conn.execute('delete from blob_garbage')
+
+
+    def delete_keys(self, select_sql: str, parameters: Sequence = ()) -> int:
+        """Delete the rows whose keys are returned by a query. Returns the number deleted."""
+        keys = [row[0] for row in self.conn.execute(select_sql, parameters).fetchall()]
+        if len(keys) == 0:
+            return 0
+
+        self.conn.executemany('delete from cache where key = ?', [(key, ) for key in keys])
+        if self.memory is not None:
+            for key in keys:
+                self.memory.discard(key)
+        return len(keys)
+
+
+    def lease_owner(self) -> str:
+        return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+    def acquire_lease(self, key: bytes, lease_seconds: float, owner: str | None = None) -> bool:
+        """Try to take the lease on a key. Returns False if someone else holds it.
+
+        Leases that have expired, or whose holder process on this host has
+        died, are taken over.
+        """
+        self.check_fork()
+        with self.lock:
+            self.flush()
+            now = time.time()
+            host = socket.gethostname()
+            owner = owner or self.lease_owner()
+
+            self.conn.execute('begin immediate')
+            try:
+                row = self.conn.execute('select owner, host, pid, expires from lease where key = ?', (key, )).fetchone()
+                if row is not None and row[0] != owner and row[3] > now and (row[1] != host or process_alive(row[2])):
+                    self.conn.rollback()
+                    return False
+
+                if row is not None and row[0] != owner:
+                    log.debug(f'Taking over lease from {row[0]}')
+
+                self.conn.execute('insert or replace into lease (key, owner, host, pid, expires) values (?, ?, ?, ?, ?)',
+                                  (key, owner, host, os.getpid(), now + lease_seconds))
+                self.conn.commit()
+                return True
+            except:
+                self.conn.rollback()
+                raise
+
+
+    def release_lease(self, key: bytes, owner: str | None = None):
+        self.write('delete from lease where key = ? and owner = ?', (key, owner or self.lease_owner()), commit=True)
+
+
+    @classmethod
+    def flush_all(cls):
+        for store in list(cls._registry.values()):
+            try:
+                store.flush()
+            except sqlite3.Error as e:
+                log.warning(f'Could not commit cache {store.name}: {e}')
+
+
+def process_alive(pid: int) -> bool:
+    if os.name == 'nt':
+        # os.kill can't probe a process on Windows, so rely on lease expiry
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+atexit.register(CacheStore.flush_all)
@@ -3,117 +3,266 @@ import sqlite3
 import os
 import pickle
 import datetime
+import time
+import asyncio
+import inspect
+import weakref
 import logging
 from pathlib import Path
-from functools import wraps
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .cache_store import CacheStore
+from .cache import Cache, CacheResult
+from coolpy.tui import StatusBar
 
 F = TypeVar("F", bound=Callable[..., Any])
 
 log = logging.getLogger('cached_function')
 
 
-def init_db(name: str):
-    db_path = os.path.expanduser(f'~/.cache/{name}-cache.sqlite')
-    cache = sqlite3.connect(db_path)
-    cache.execute('create table if not exists cache (args blob, kwargs blob, return_value blob, timestamp integer, unique(args, kwargs))')
-    cache.execute('create index if not exists cache_args on cache(args)')
-    cache.execute('create index if not exists cache_timestamp on cache(timestamp)')
-    cache.execute('create index if not exists cache_kwargs on cache(kwargs)')
-    return cache
+def init_db(name: str) -> sqlite3.Connection:
+    return CacheStore.get(name).conn
 
 
 def add_cache_entry(name: str, args: tuple, kwargs: dict, return_value: Any):
-    cache = init_db(name)
-    now_timestamp = int(datetime.datetime.now().timestamp())
-    cache.execute('insert or replace into cache (args, kwargs, return_value, timestamp) values (?, ?, ?, ?)', (pickle.dumps(args), pickle.dumps(kwargs), pickle.dumps(return_value), now_timestamp))
-    cache.commit()
+    Cache(name, days=None).store(Cache.key(args, kwargs), return_value, args, kwargs)
 
 
 def delete_cache_entry(name: str, args: tuple, kwargs: dict):
-    cache = init_db(name)
-    cache.execute('delete from cache where args is ? and kwargs is ?', (pickle.dumps(args), pickle.dumps(kwargs)))
-    cache.commit()
-
-
-def cached_function(name: str | None=None, days=28.0) -> Callable[[F], F]:
+    Cache(name, days=None).invalidate(Cache.key(args, kwargs))
+
+
+def function_cache_name(func: Callable) -> str:
+    name = func.__name__
+    if hasattr(func, '__module__'):
+        name = func.__module__ + '.' + name
+    return name
+
+
+def cached_function(name: str | Callable | None=None, days=28.0, memory_entries: int=0, memory_bytes: int=64 * 1024 * 1024,
+                    stampede: Literal['wait', 'stale'] | None=None, lease_seconds: float=60.0, lease_timeout: float=30.0,
+                    max_bytes: int | None=None, max_entries: int | None=None,
+                    compress_threshold: int | None=None, file_threshold: int | None=None) -> Callable[[F], F]:
+    """Cache a function's return values in ~/.cache/<name>-cache.sqlite.
+
+    Args:
+        name (str, optional): The cache name. Defaults to the function's qualified name.
+        days (float, optional): How long entries stay fresh. Defaults to 28.0.
+        memory_entries (int, optional): If non-zero, keep up to this many recently used
+            return values in memory in front of SQLite. Defaults to 0.
+        memory_bytes (int, optional): Upper bound on the pickled size of the values kept in memory.
+        stampede (str, optional): Protect misses with a lease shared by every process using the cache.
+            The lease holder computes the value; with 'wait' the others wait for it, with 'stale' they
+            return the expired value if there is one. Defaults to None (no leases).
+        lease_seconds (float, optional): How long a lease lasts before it can be taken over. Defaults to 60.0.
+        lease_timeout (float, optional): How long to wait for another process's lease before computing anyway.
+        max_bytes (int, optional): Evict least recently used entries once the cache holds more than this many bytes.
+        max_entries (int, optional): Evict least recently used entries once the cache holds more than this many rows.
+        compress_threshold (int, optional): Compress pickled return values larger than this many bytes.
+        file_threshold (int, optional): Store pickled return values larger than this many bytes in files
+            next to the database, read back through a memory map.
+    """
+    if callable(name):
+        # Used as a bare decorator: @cached_function
+        return cached_function(days=days, memory_entries=memory_entries, memory_bytes=memory_bytes,
+                               stampede=stampede, lease_seconds=lease_seconds, lease_timeout=lease_timeout,
+                               max_bytes=max_bytes, max_entries=max_entries,
+                               compress_threshold=compress_threshold, file_threshold=file_threshold)(name)
 
     def ed(func: F) -> F:
         nonlocal name
         if name is None:
-            name = func.__name__
-            if hasattr(func, '__module__'):
-                name = func.__module__ + '.' + name
+            name = function_cache_name(func)
 
-        seconds = int(days * 24 * 60 * 60)
+        cache = Cache(name, days=days, memory_entries=memory_entries, memory_bytes=memory_bytes,
+                      stampede=stampede, lease_seconds=lease_seconds, lease_timeout=lease_timeout,
+                      max_bytes=max_bytes, max_entries=max_entries,
+                      compress_threshold=compress_threshold, file_threshold=file_threshold)
 
-        cache = init_db(name)
-
-        cache.execute('delete from cache where timestamp < ?', (datetime.datetime.now().timestamp() - seconds, ))
-        cache.commit()
+        if inspect.iscoroutinefunction(func):
+            return cached_coroutine_function(func, cache)
 
         @wraps(func)
         def cached_func(*args, **kwargs):
             log.debug(f'Checking cache for {name} with args={args} kwargs={kwargs}')
+            return cache.get_or_compute(Cache.key(args, kwargs), lambda: func(*args, **kwargs), args, kwargs).value
 
-            row = cache.execute('select return_value, timestamp from cache where args is ? and kwargs is ?', (pickle.dumps(args), pickle.dumps(kwargs))).fetchone()
-            cache.commit()
-
-            now_timestamp = int(datetime.datetime.now().timestamp())
-
-            if row is not None:
-                return_value, timestamp = row
-                if timestamp > now_timestamp - seconds:
-                    log.debug('Cache hit!')
-                    return pickle.loads(return_value)
-                else:
-                    log.debug(f'Too old: {timestamp} < {datetime.datetime.now().timestamp()} - {seconds}')
-            else:
-                log.debug('Cache miss')
-
-            return_value = func(*args, **kwargs)
-
-            add_cache_entry(name, args, kwargs, return_value)
-
-            return return_value
-
+        cached_func.cache = cache
+        cached_func.prefetch = partial(prefetch, cached_func)
         return cached_func
     return ed
 
 
-def is_cache_hit(name: str | None=None, days=28.0) -> Callable[[F], Callable[..., bool]]:
+def call_uncached(cached_func: Callable, args: tuple, kwargs: dict) -> Any:
+    # Pickled by reference for process pools, the decorated function is the module attribute
+    return cached_func.__wrapped__(*args, **kwargs)
+
+
+def prefetch(cached_func: Callable, calls: Iterable[Any], kwargs: dict={}, max_workers: int | None=None,
+             pool: Literal['thread', 'process']='thread', batch_size: int=1000, progress: bool=True) -> int:
+    """Warm the cache of a cached_function-decorated function, usually called as `func.prefetch(calls)`.
+
+    Keys that are already fresh are filtered out up front, the rest are computed
+    on a thread or process pool and stored `batch_size` at a time, each batch in
+    one transaction. Leases are not taken, so don't warm a cache that other
+    processes are filling at the same time.
+
+    Args:
+        calls (Iterable): Positional arguments for each call, as a tuple, or a single non-tuple argument.
+        kwargs (dict, optional): Keyword arguments shared by every call.
+        max_workers (int, optional): Size of the pool. Defaults to the executor's default.
+        pool (str, optional): 'thread', or 'process' for CPU-bound functions. With 'process',
+            the function and its arguments must be picklable. Defaults to 'thread'.
+        batch_size (int, optional): Results per write transaction. Defaults to 1000.
+        progress (bool, optional): Report progress with a StatusBar. Defaults to True.
+
+    Returns:
+        int: The number of values computed.
+    """
+    cache: Cache = cached_func.cache
+
+    missing: dict[bytes, tuple] = {}
+    for args in calls:
+        args = args if isinstance(args, tuple) else (args, )
+        missing.setdefault(Cache.key(args, kwargs), args)
+
+    for key in cache.fresh_keys(missing.keys()):
+        del missing[key]
+
+    log.debug(f'Prefetching {len(missing)} entries for {cache.name}')
+    if len(missing) == 0:
+        return 0
+
+    status_bar = StatusBar(len(missing)) if progress else None
+    executor_type = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+    # Process pools pay for pickling on every task, so send them in chunks
+    chunksize = max(1, min(64, len(missing) // ((max_workers or os.cpu_count() or 1) * 4))) if pool == 'process' else 1
+
+    batch = []
+    with executor_type(max_workers=max_workers) as executor:
+        try:
+            results = executor.map(partial(call_uncached, cached_func, kwargs=kwargs), missing.values(), chunksize=chunksize)
+            for done, (key, args, return_value) in enumerate(zip(missing.keys(), missing.values(), results), 1):
+                batch.append((key, return_value, args, kwargs))
+                if len(batch) >= batch_size:
+                    cache.store_many(batch)
+                    batch = []
+                if status_bar is not None:
+                    status_bar.print_status(done)
+        finally:
+            # Keep whatever was computed before an error
+            cache.store_many(batch)
+
+    if status_bar is not None:
+        status_bar.finish()
+    return len(missing)
+
+
+def cached_coroutine_function(func: F, cache: Cache) -> F:
+    """Async wrapper for cached_function.
+
+    SQLite I/O runs in worker threads, and concurrent awaits of the same key
+    on one event loop share a single in-flight computation. With a stampede
+    mode, that computation also takes the key's cross-process lease.
+    """
+    in_flight: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[bytes, asyncio.Future]] = weakref.WeakKeyDictionary()
+
+    async def compute(key: bytes, args: tuple, kwargs: dict):
+        result = await asyncio.to_thread(cache.lookup, key)
+        if result.hit:
+            return result.value
+
+        if cache.stampede is not None:
+            return await compute_with_lease(key, args, kwargs)
+
+        return_value = await func(*args, **kwargs)
+
+        await asyncio.to_thread(cache.store, key, return_value, args, kwargs)
+
+        return return_value
+
+    async def compute_with_lease(key: bytes, args: tuple, kwargs: dict):
+        # Same protocol as Cache.compute_with_lease, with the waits on the event loop
+        deadline = time.monotonic() + cache.lease_timeout
+        delay = 0.05
+        # Worker threads vary between calls, so the lease belongs to the event loop's thread
+        owner = cache.backend.lease_owner()
+
+        while True:
+            if await asyncio.to_thread(cache.backend.acquire_lease, key, cache.lease_seconds, owner):
+                try:
+                    result = await asyncio.to_thread(cache.lookup, key)
+                    if result.hit:
+                        return result.value
+
+                    return_value = await func(*args, **kwargs)
+                    await asyncio.to_thread(cache.store, key, return_value, args, kwargs, True)
+                    return return_value
+                finally:
+                    await asyncio.to_thread(cache.backend.release_lease, key, owner)
+
+            if cache.stampede == 'stale':
+                result = await asyncio.to_thread(cache.lookup, key, True)
+                if result.hit or result.stale:
+                    return result.value
+
+            if time.monotonic() > deadline:
+                log.warning(f'Timed out waiting for the lease on {cache.name}, computing anyway')
+                return_value = await func(*args, **kwargs)
+                await asyncio.to_thread(cache.store, key, return_value, args, kwargs, True)
+                return return_value
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+            result = await asyncio.to_thread(cache.lookup, key)
+            if result.hit:
+                return result.value
+
+    @wraps(func)
+    async def cached_coroutine(*args, **kwargs):
+        log.debug(f'Checking cache for {cache.name} with args={args} kwargs={kwargs}')
+
+        key = Cache.key(args, kwargs)
+        result = cache.lookup_memory(key)
+        if result.hit:
+            return result.value
+
+        flights = in_flight.setdefault(asyncio.get_running_loop(), {})
+        future = flights.get(key)
+        if future is None:
+            log.debug(f'Starting computation for {cache.name}')
+            future = flights[key] = asyncio.ensure_future(compute(key, args, kwargs))
+            future.add_done_callback(lambda done: flights.pop(key) if flights.get(key) is done else None)
+
+        # Shielded so that one cancelled caller doesn't cancel the others
+        return await asyncio.shield(future)
+
+    cached_coroutine.cache = cache
+    return cached_coroutine
+
+
+def is_cache_hit(name: str | Callable | None=None, days=28.0) -> Callable[[F], Callable[..., bool]]:
+    if callable(name):
+        return is_cache_hit(days=days)(name)
 
     def ed(func: F) -> Callable[..., bool]:
         nonlocal name
         if name is None:
-            name = func.__name__
-            if hasattr(func, '__module__'):
-                name = func.__module__ + '.' + name
+            name = function_cache_name(func)
 
         log.debug(f'Using name: "{name}"')
 
-        seconds = int(days * 24 * 60 * 60)
-
-        cache = init_db(name)
+        cache = Cache(name, days=days)
 
-        cache.execute('delete from cache where timestamp < ?', (datetime.datetime.now().timestamp() - seconds, ))
-        cache.commit()
+        if inspect.iscoroutinefunction(func):
+            async def cached_coroutine(*args, **kwargs) -> bool:
+                return await asyncio.to_thread(cache.contains, Cache.key(args, kwargs))
+            return cached_coroutine
 
         def cached_func(*args, **kwargs):
             log.debug(f'Checking cache for {name} with args={args} kwargs={kwargs}')
-
-            row = cache.execute('select return_value, timestamp from cache where args is ? and kwargs is ?', (pickle.dumps(args), pickle.dumps(kwargs))).fetchone()
-            cache.commit()
-
-            now_timestamp = int(datetime.datetime.now().timestamp())
-
-            if row is not None:
-                return_value, timestamp = row
-                if timestamp > now_timestamp - seconds:
-                    return True
-                else:
-                    return False
-            else:
-                return False
+            return cache.contains(Cache.key(args, kwargs))
 
         return cached_func
 
@@ -1,57 +1,395 @@
+import io
 import time
 from .cached_function import *
+from .cache import Cache, CacheResult, MISS
+from .fingerprint import request_fingerprint, bind_request, join_list_params, DEFAULT_KEY_HEADERS
+from .rate_limit import HostRateLimiter, retry_after_seconds
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 import logging
+import threading
 import requests
 from requests import Session
+from requests.structures import CaseInsensitiveDict
+from typing import NamedTuple, Mapping, BinaryIO
 from coolpy.tui import color_text
 
+__all__ = ['CachedRequests', 'CachedResponse', 'CACHED_HEADERS', 'CACHE_NAME', 'USER_AGENT',
+           'as_response', 'get_session', 'request_headers', 'session', 'session_request']
+
 log = logging.getLogger(__name__)
 log.debug(f'Initialized CachedRequests logger {__name__}')
 
-session = requests.Session()
-session.headers.update({'User-Agent': 'CoolpyCachedRequestsBot/0.1.0 (https://www.sanvillesoftware.com; edsanville@gmail.com) coolpy/0.1.0'})
+USER_AGENT = 'CoolpyCachedRequestsBot/0.1.0 (https://www.sanvillesoftware.com; edsanville@gmail.com) coolpy/0.1.0'
+
+_session: Session | None = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> Session:
+    """The Session shared by every CachedRequests, created on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.headers.update({'User-Agent': USER_AGENT})
+        return _session
+
+
+def __getattr__(name: str):
+    # The module-level session is created lazily
+    if name == 'session':
+        return get_session()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Response headers worth keeping in the cache. Transfer headers such as
+# Content-Encoding and Content-Length no longer describe the decoded body.
+CACHED_HEADERS = {
+    'age', 'cache-control', 'content-disposition', 'content-language', 'content-type', 'date',
+    'etag', 'expires', 'last-modified', 'link', 'location', 'retry-after', 'vary',
+}
+
+
+class CachedResponse(NamedTuple):
+    """The parts of a requests.Response that are kept in the cache."""
+    status_code: int
+    reason: str
+    url: str
+    headers: tuple[tuple[str, str], ...]
+    encoding: str | None
+    content: bytes
+    # The request's values for the headers named by the response's Vary header, from its
+    # session and request headers: what a later lookup can compare against
+    vary: tuple[tuple[str, str | None], ...] = ()
+    # Digest of the blob file holding the body of a streamed response, whose content is then empty
+    body: str | None = None
+
+    @staticmethod
+    def from_response(response: requests.Response, body: str | None=None,
+                      request_headers: Mapping[str, str] | None=None) -> 'CachedResponse':
+        headers = tuple((key, value) for key, value in response.headers.items() if key.lower() in CACHED_HEADERS)
+        vary = ()
+        if 'vary' in response.headers:
+            names = [name.strip().lower() for name in response.headers['vary'].split(',') if name.strip() != '']
+            request_headers = request_headers if request_headers is not None else CaseInsensitiveDict()
+            vary = tuple((name, request_headers.get(name)) for name in names)
+        content = response.content if body is None else b''
+        return CachedResponse(response.status_code, response.reason, response.url, headers, response.encoding, content, vary, body)
+
+
+    def matches(self, request_headers: Mapping[str, str]) -> bool:
+        """Whether this response is valid for a request with these headers, according to Vary."""
+        return all(name != '*' and request_headers.get(name) == value for name, value in self.vary)
+
+
+    def to_response(self, raw: BinaryIO | None=None) -> requests.Response:
+        """Rebuild a Response. The body is only decoded when .text or .json() is used.
+
+        Given `raw`, a file-like object holding the body, the Response reads
+        its body from there as if it had been sent with stream=True.
+        """
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.url = self.url
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = self.encoding
+        if raw is None:
+            response._content = self.content
+            response._content_consumed = True
+        else:
+            response.raw = raw
+        return response
+
+
+    def conditional_headers(self) -> dict[str, str]:
+        """If-None-Match / If-Modified-Since headers for revalidating this response."""
+        headers = CaseInsensitiveDict(self.headers)
+        conditional = {}
+        if 'etag' in headers:
+            conditional['If-None-Match'] = headers['etag']
+        if 'last-modified' in headers:
+            conditional['If-Modified-Since'] = headers['last-modified']
+        return conditional
+
+
+    def refreshed(self, not_modified: requests.Response) -> 'CachedResponse':
+        """This response with any cache headers updated by a 304 Not Modified."""
+        headers = CaseInsensitiveDict(self.headers)
+        for key, value in not_modified.headers.items():
+            if key.lower() in CACHED_HEADERS:
+                headers[key] = value
+        return self._replace(headers=tuple(headers.items()))
+
+
+def as_response(value: CachedResponse | requests.Response) -> requests.Response:
+    # Entries written before CachedResponse existed hold whole Responses
+    return value.to_response() if isinstance(value, CachedResponse) else value
 
-def session_request(*args, **kwargs):
-    return session.request(*args, **kwargs)
+
+CACHE_NAME = 'cached_requests'
+
+
+def session_request(*args, **kwargs) -> CachedResponse:
+    return CachedResponse.from_response(get_session().request(*args, **kwargs), request_headers=request_headers(kwargs))
+
+
+def request_headers(kwargs: dict) -> CaseInsensitiveDict:
+    """The session headers with a request's own headers on top.
+
+    Headers that requests adds while sending, such as Cookie from the session's
+    cookie jar and Authorization from auth=, are left out, so responses that
+    Vary on them are matched the same way when stored and when looked up.
+    """
+    headers = CaseInsensitiveDict(get_session().headers)
+    headers.update(kwargs.get('headers') or {})
+    return headers
 
 
 class CachedRequests:
+    """Cached HTTP requests with throttling and retries.
+
+    Every request does a single cache lookup. With `revalidate=True`,
+    expired entries are kept for another `revalidate_days` along with their
+    ETag / Last-Modified validators, and are refreshed with a conditional
+    request: a 304 Not Modified renews the entry without downloading the
+    body again. With `stale_while_revalidate` as well, the expired response
+    is returned at once and revalidated in the background.
+
+    Network requests are spaced `throttle_seconds` apart per host by a token
+    bucket, which lets `burst` requests through back to back. Retry-After
+    answers pause only the host that sent them.
+
+    Requests are keyed by a canonical fingerprint (see request_fingerprint),
+    so reordered params or a different User-Agent share one entry. Only the
+    `key_headers` are part of the key; a cached response whose Vary header
+    names other headers is only used when those match too. With
+    `list_separator`, list-valued params are joined into one value before
+    the request is keyed and sent.
+
+    With `stream=True`, a successful response body is written to a blob
+    file next to the cache in chunks of CHUNK_SIZE instead of being read
+    into memory, and `response.raw` is a read-only memory map of that file,
+    on a miss and on a hit alike. memoryview(response.raw) gives the bytes
+    without copying them; `response.content` still works but reads it all.
+    """
     expiration_days: float
     throttle_seconds: float
+    revalidate: bool
+    stale_while_revalidate: bool
+    limiter: HostRateLimiter
+    cache: Cache
+    key_headers: tuple[str, ...]
+    list_separator: str | None
 
-    def __init__(self, expiration_days: float=1, throttle_seconds: float=0.0):
+    RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+    ATTEMPT_LIMIT = 3
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, expiration_days: float=1, throttle_seconds: float=0.0, memory_entries: int=0,
+                 revalidate: bool=False, revalidate_days: float=28.0, stale_while_revalidate: bool=False,
+                 burst: int=1, key_headers: Iterable[str]=DEFAULT_KEY_HEADERS, list_separator: str | None=None):
         self.expiration_days = expiration_days
+        self.key_headers = tuple(key_headers)
+        self.list_separator = list_separator
         self.throttle_seconds = throttle_seconds
-        self.cached_request = cached_function(name='cached_requests', days=expiration_days)(session_request)
-        self.is_cache_hit = is_cache_hit(name='cached_requests', days=expiration_days)(session_request)
+        self.limiter = HostRateLimiter(1.0 / throttle_seconds if throttle_seconds > 0 else None, burst)
+        self.revalidate = revalidate
+        self.stale_while_revalidate = stale_while_revalidate
+        self.cache = Cache(CACHE_NAME, days=expiration_days, memory_entries=memory_entries,
+                           compress_threshold=16 * 1024, file_threshold=1024 * 1024,
+                           keep_days=expiration_days + revalidate_days if revalidate else None)
+
+        self.background = None
+        self.revalidating: set[bytes] = set()
+        self.revalidating_lock = threading.Lock()
+
+
+    def normalize(self, args: tuple, kwargs: dict) -> tuple[tuple, dict, bytes]:
+        """Returns the (args, kwargs) to send and the request's cache key."""
+        if self.list_separator is not None:
+            request = bind_request(args, kwargs)
+            if 'params' in request:
+                request['params'] = join_list_params(request['params'], self.list_separator)
+                args, kwargs = (request.pop('method'), request.pop('url')), request
+        return args, kwargs, request_fingerprint(args, kwargs, self.key_headers)
+
+
+    def lookup(self, key: bytes, kwargs: dict) -> CacheResult:
+        result = self.cache.lookup(key, allow_stale=self.revalidate)
+
+        if result.hit and isinstance(result.value, CachedResponse) and len(result.value.vary) > 0:
+            if not result.value.matches(request_headers(kwargs)):
+                log.debug('Cached response varies on headers that differ, refetching')
+                return MISS
+
+        return result
+
+
+    def is_cache_hit(self, *args, **kwargs) -> bool:
+        args, kwargs, key = self.normalize(args, kwargs)
+        return self.lookup(key, kwargs).hit
+
+
+    def cached_request(self, *args, **kwargs) -> CachedResponse:
+        """The cached response record for a request, without throttling or retries."""
+        args, kwargs, key = self.normalize(args, kwargs)
+        return self.cache.get_or_compute(key, lambda: session_request(*args, **kwargs), args, kwargs).value
 
 
     def request(self, *args, **kwargs):
-        is_cache_hit = self.is_cache_hit(*args, **kwargs)
+        args, kwargs, key = self.normalize(args, kwargs)
+        result = self.lookup(key, kwargs)
         log.debug(f'Request args: {args}, kwargs: {kwargs}')
-        log.debug(color_text(f'Cache hit: {is_cache_hit}', 'green' if is_cache_hit else 'yellow'))
+        log.debug(color_text(f'Cache hit: {result.hit}', 'green' if result.hit else 'yellow'))
+        return self.resolve(key, args, kwargs, result)
+
+
+    def to_response(self, value: CachedResponse | requests.Response, stream: bool) -> requests.Response:
+        """as_response, with streamed bodies opened as memory maps.
+
+        Raises FileNotFoundError if the body's blob file is gone.
+        """
+        if isinstance(value, CachedResponse):
+            if value.body is not None:
+                return value.to_response(self.cache.backend.open_blob(value.body))
+            if stream:
+                return value.to_response(io.BytesIO(value.content))
+        return as_response(value)
 
-        RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
-        ATTEMPT_LIMIT = 3
 
-        for attempt in range(ATTEMPT_LIMIT):
-            response = self.cached_request(*args, **kwargs)
+    def resolve(self, key: bytes, args: tuple, kwargs: dict, result: CacheResult) -> requests.Response:
+        """Turn a lookup result into a response, going to the network on a miss."""
+        stream = bool(kwargs.get('stream'))
 
-            if response.status_code not in RETRYABLE_STATUS_CODES:
-                if not is_cache_hit:
-                    time.sleep(self.throttle_seconds)
+        if result.hit:
+            try:
+                response = self.to_response(result.value, stream)
+                if response.status_code not in self.RETRYABLE_STATUS_CODES:
+                    return response
+            except FileNotFoundError:
+                log.debug('Cached response body is gone, refetching')
+            self.cache.invalidate(key)
+            result = MISS
+
+        host = request_host(args, kwargs)
+
+        for attempt in range(self.ATTEMPT_LIMIT):
+            response = self.to_response(self.send(key, args, kwargs, result, host), stream)
+
+            if response.status_code not in self.RETRYABLE_STATUS_CODES:
                 return response
 
-            delete_cache_entry('cached_requests', args, kwargs)
+            self.cache.invalidate(key)
+            result = MISS
 
-            retry_after = response.headers.get('Retry-After', self.throttle_seconds * (3 ** (attempt + 1)))
+            # Exponential backoff, unless the server says how long to wait
+            retry_after = retry_after_seconds(response.headers.get('Retry-After'), self.throttle_seconds * (3 ** (attempt + 1)))
 
-            log.warning(color_text(f'Retrying request due to status code {response.status_code}, attempt {attempt + 1}/{ATTEMPT_LIMIT}, {retry_after=}', 'yellow'))
+            log.warning(color_text(f'Retrying request due to status code {response.status_code}, attempt {attempt + 1}/{self.ATTEMPT_LIMIT}, {retry_after=}', 'yellow'))
 
-            time.sleep(float(retry_after))  # Exponential backoff
+            self.limiter.pause(host, retry_after)
+
+        raise Exception(f"Request failed after {self.ATTEMPT_LIMIT} attempts with {response.__dict__}")
+
+
+    def send(self, key: bytes, args: tuple, kwargs: dict, result: CacheResult, host: str) -> CachedResponse:
+        """Fetch and store a missed request, revalidating the stale entry if there is one."""
+        stale = result.value if result.stale and isinstance(result.value, CachedResponse) else None
+
+        if stale is not None and len(stale.conditional_headers()) > 0:
+            if not self.stale_while_revalidate:
+                return self.conditional_request(key, args, kwargs, stale, host)
+
+            with self.revalidating_lock:
+                if key not in self.revalidating:
+                    self.revalidating.add(key)
+                    if self.background is None:
+                        self.background = ThreadPoolExecutor(max_workers=2, thread_name_prefix='revalidate')
+                    self.background.submit(self.background_revalidate, key, args, kwargs, stale, host)
+
+            log.debug('Serving stale response while revalidating')
+            return stale
+
+        self.limiter.acquire(host)
+        record = self.record(get_session().request(*args, **kwargs), kwargs)
+        self.cache.store(key, record, args, kwargs, body=record.body)
+        return record
+
+
+    def record(self, response: requests.Response, kwargs: dict) -> CachedResponse:
+        """The cache record for the response to a request with these kwargs.
+
+        Successful streamed bodies go to a blob file chunk by chunk.
+        """
+        headers = request_headers(kwargs)
+        if not kwargs.get('stream') or not 200 <= response.status_code < 300:
+            return CachedResponse.from_response(response, request_headers=headers)
+
+        with response:
+            digest, size = self.cache.backend.write_blob(response.iter_content(self.CHUNK_SIZE))
+        log.debug(f'Streamed {size} bytes from {response.url} to disk')
+        return CachedResponse.from_response(response, body=digest, request_headers=headers)
+
+
+    def background_revalidate(self, key: bytes, args: tuple, kwargs: dict, stale: CachedResponse, host: str):
+        try:
+            self.conditional_request(key, args, kwargs, stale, host)
+        except Exception as e:
+            log.warning(f'Background revalidation failed: {e}')
+        finally:
+            with self.revalidating_lock:
+                self.revalidating.discard(key)
+
+
+    def conditional_request(self, key: bytes, args: tuple, kwargs: dict, stale: CachedResponse, host: str) -> CachedResponse:
+        headers = dict(kwargs.get('headers') or {})
+        headers.update(stale.conditional_headers())
+
+        self.limiter.acquire(host)
+        response = get_session().request(*args, **{**kwargs, 'headers': headers})
+
+        if response.status_code == 304:
+            log.debug(color_text('Not modified, refreshing cached response', 'green'))
+            record = stale.refreshed(response)
+        else:
+            record = self.record(response, kwargs)
+
+        # Stored under the original arguments, not the conditional headers
+        self.cache.store(key, record, args, kwargs, body=record.body)
+        return record
+
+
+    def request_many(self, request_args: Iterable[tuple], max_workers: int=8) -> list[requests.Response]:
+        """Send many requests, returning their responses in order.
+
+        Each request is a tuple of positional arguments for `request`, optionally
+        ending with a dict of keyword arguments, e.g. `('GET', url, {'params': params})`.
+        Cache hits are served right away and misses go through a pool of
+        `max_workers` threads, rate limited per host.
+        """
+        results: list[requests.Response | None] = []
+        misses = []
+
+        for args, kwargs in map(split_request, request_args):
+            args, kwargs, key = self.normalize(args, kwargs)
+            result = self.lookup(key, kwargs)
+            if result.hit:
+                results.append(self.resolve(key, args, kwargs, result))
+            else:
+                misses.append((len(results), key, args, kwargs, result))
+                results.append(None)
+
+        log.debug(f'request_many: {len(results) - len(misses)} cache hits, {len(misses)} misses')
+
+        if len(misses) > 0:
+            with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='request_many') as pool:
+                futures = [(index, pool.submit(self.resolve, key, args, kwargs, result)) for index, key, args, kwargs, result in misses]
+                for index, future in futures:
+                    results[index] = future.result()
+
+        return results
 
-        raise Exception(f"Request failed after {ATTEMPT_LIMIT} attempts with {response.__dict__}")
-    
 
     def get(self, *args, **kwargs):
         return self.request('GET', *args, **kwargs)
@@ -65,5 +403,21 @@ class CachedRequests:
         return self.request('PUT', *args, **kwargs)
 
 
+    def get_many(self, urls: Iterable[str], max_workers: int=8, **kwargs) -> list[requests.Response]:
+        return self.request_many([('GET', url, kwargs) for url in urls], max_workers=max_workers)
+
+
+def split_request(request: tuple) -> tuple[tuple, dict]:
+    """Split a request_many entry into (args, kwargs)."""
+    if len(request) > 0 and isinstance(request[-1], dict):
+        return tuple(request[:-1]), request[-1]
+    return tuple(request), {}
+
+
+def request_host(args: tuple, kwargs: dict) -> str:
+    url = args[1] if len(args) > 1 else kwargs.get('url', '')
+    return urlsplit(url).netloc
+
+
 if __name__ == '__main__':
     requests = CachedRequests(expiration_days=28, throttle_seconds=5)
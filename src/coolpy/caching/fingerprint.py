@@ -0,0 +1,113 @@
+from typing import *
+from urllib.parse import urlsplit, urlunsplit, parse_qsl
+import hashlib
+from .cache_key import cache_key, canonical_bytes
+
+# Positional parameters of requests.Session.request, after self
+REQUEST_PARAMETERS = ('method', 'url', 'params', 'data', 'headers', 'cookies', 'files', 'auth', 'timeout',
+                      'allow_redirects', 'proxies', 'hooks', 'stream', 'verify', 'cert', 'json')
+
+# Arguments that change how a request is sent but not what comes back
+TRANSPORT_PARAMETERS = {'timeout', 'proxies', 'hooks', 'stream', 'verify', 'cert'}
+
+# Request headers that are part of the cache key unless configured otherwise
+DEFAULT_KEY_HEADERS = ('accept', 'accept-language', 'authorization')
+
+# Request headers that change the response body, always part of the cache key
+BODY_HEADERS = ('content-type', 'if-range', 'range')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def bind_request(args: tuple, kwargs: dict) -> dict[str, Any]:
+    """Map request(...) arguments to their parameter names."""
+    request = dict(zip(REQUEST_PARAMETERS, args))
+    request.update(kwargs)
+    return request
+
+
+def join_list_params(params: Any, separator: str) -> Any:
+    """Join list-valued params with a separator, e.g. ['a', 'b'] -> 'a|b' for the MediaWiki API."""
+    if not isinstance(params, dict):
+        return params
+    return {key: separator.join(str(item) for item in value) if isinstance(value, (list, tuple, set)) else value
+            for key, value in params.items()}
+
+
+def param_pairs(params: Any) -> list[tuple[str, str]]:
+    """Flatten params the way requests encodes them into (key, value) string pairs."""
+    if params is None:
+        return []
+    if isinstance(params, bytes):
+        params = params.decode()
+    if isinstance(params, str):
+        return parse_qsl(params, keep_blank_values=True)
+
+    items = params.items() if isinstance(params, dict) else params
+    pairs = []
+    for key, value in items:
+        values = value if isinstance(value, (list, tuple)) else [value]
+        for item in values:
+            if item is not None:
+                pairs.append((str(key), item.decode() if isinstance(item, bytes) else str(item)))
+    return pairs
+
+
+def normalize_url(url: str, params: Any = None) -> tuple[str, tuple[tuple[str, str], ...]]:
+    """Split a URL into its normalized form without the query, and its sorted query pairs.
+
+    The scheme and host are lowercased, default ports and fragments are
+    dropped, and params are merged into the query. A password is replaced
+    by its digest.
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f'{netloc}:{parts.port}'
+    if parts.password is not None:
+        password = hashlib.blake2b(parts.password.encode(), digest_size=16).hexdigest()
+        netloc = f'{parts.username}:{password}@{netloc}'
+    elif parts.username is not None:
+        netloc = f'{parts.username}@{netloc}'
+
+    query = parse_qsl(parts.query, keep_blank_values=True) + param_pairs(params)
+    # Sort by name only: the order of repeated names can matter
+    query.sort(key=lambda pair: pair[0])
+
+    return urlunsplit((scheme, netloc, parts.path or '/', '', '')), tuple(query)
+
+
+def body_digest(data: Any, json: Any) -> bytes | None:
+    if data is None and json is None:
+        return None
+    if isinstance(data, str):
+        data = data.encode()
+    if isinstance(data, (dict, list, tuple)):
+        data = canonical_bytes(tuple(sorted(param_pairs(data))))
+    elif not isinstance(data, (bytes, type(None))):
+        data = canonical_bytes(data)
+    return hashlib.blake2b(canonical_bytes((data, json)), digest_size=16).digest()
+
+
+def request_fingerprint(args: tuple, kwargs: dict, key_headers: Iterable[str] = DEFAULT_KEY_HEADERS) -> bytes:
+    """Cache key for a request(...) call that is the same for equivalent requests.
+
+    It covers the method, normalized URL, sorted query, a hash of the body,
+    and the values of `key_headers` and BODY_HEADERS only. Other headers
+    (User-Agent, ...) and transport options such as timeouts don't affect it.
+    """
+    request = bind_request(args, kwargs)
+    method = str(request.pop('method', 'GET')).upper()
+    url, query = normalize_url(request.pop('url', ''), request.pop('params', None))
+    body = body_digest(request.pop('data', None), request.pop('json', None))
+
+    headers = {str(key).lower(): value for key, value in (request.pop('headers', None) or {}).items()}
+    names = sorted({name.lower() for name in key_headers} | set(BODY_HEADERS))
+    selected_headers = tuple((name, headers[name]) for name in names if headers.get(name) is not None)
+
+    options = {key: value for key, value in request.items() if key not in TRANSPORT_PARAMETERS and value is not None}
+    if options.get('allow_redirects') is True:
+        del options['allow_redirects']
+
+    return cache_key((method, url, query, body, selected_headers), options)
@@ -0,0 +1,69 @@
+from typing import *
+from collections import OrderedDict
+import threading
+
+
+class MemoryCache:
+    """An in-process LRU cache bounded by entry count and total bytes.
+
+    Values are kept as live objects, so a hit costs a dict lookup with no
+    SQL round trip and no unpickling. Callers get the same object on every
+    hit and must not mutate it.
+    """
+    max_entries: int
+    max_bytes: int
+    total_bytes: int
+    entries: OrderedDict[bytes, tuple[Any, int, int]]
+    lock: threading.Lock
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key: bytes) -> tuple[Any, int, int] | None:
+        """Returns (value, timestamp, size) and marks the entry as recently used, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+
+    def put(self, key: bytes, value: Any, timestamp: int, size: int):
+        with self.lock:
+            self._discard(key)
+
+            if size > self.max_bytes or self.max_entries <= 0:
+                return
+
+            self.entries[key] = (value, timestamp, size)
+            self.total_bytes += size
+
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+
+    def discard(self, key: bytes):
+        with self.lock:
+            self._discard(key)
+
+
+    def _discard(self, key: bytes):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,97 @@
+from typing import *
+import email.utils
+import threading
+import time
+
+
+class TokenBucket:
+    """A thread-safe token bucket: `rate` tokens per second, holding at most `capacity`.
+
+    A rate of None means unlimited, but the bucket can still be paused,
+    e.g. to honour a Retry-After header.
+    """
+    rate: float | None
+    capacity: float
+    tokens: float
+    updated: float
+    paused_until: float
+    lock: threading.Lock
+
+    def __init__(self, rate: float | None, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        return
+                    wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+    def pause(self, seconds: float):
+        """Hold back every caller for the next `seconds`."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = min(1.0, self.capacity)
+            self.updated = self.paused_until
+
+
+class HostRateLimiter:
+    """One TokenBucket per host, created on first use."""
+    rate: float | None
+    capacity: float
+    buckets: dict[str, TokenBucket]
+    lock: threading.Lock
+
+    def __init__(self, rate: float | None, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+
+    def bucket(self, host: str) -> TokenBucket:
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(self.rate, self.capacity)
+            return bucket
+
+
+    def acquire(self, host: str):
+        self.bucket(host).acquire()
+
+
+    def pause(self, host: str, seconds: float):
+        self.bucket(host).pause(seconds)
+
+
+def retry_after_seconds(value: str | None, default: float) -> float:
+    """Parse a Retry-After header, given either in seconds or as an HTTP date."""
+    if value is None:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return default
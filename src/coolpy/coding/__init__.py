@@ -1,102 +1,429 @@
-from typing import Any, Callable, TypeVar, get_type_hints, get_origin, get_args, Literal
+from typing import Any, Callable, Iterable, TypeVar, Union, get_type_hints, get_origin, get_args, Literal
+import dataclasses
+import inspect
 import types
 
 normal_types = set([int, float, str, bool, type(None)])
 
 T = TypeVar("T")
 
+# Compiled encoders by type, and decoders by class or type hint, built on first use
+encoders: dict[type, Callable[[Any], Any]] = {}
+decoders: dict[Any, Callable[[Any], Any]] = {}
+
+
 def encode(obj: any):
     t = type(obj)
 
     if t in normal_types:
         return obj
-    
+
+    encoder = encoders.get(t)
+    if encoder is None:
+        encoder = encoders[t] = compile_encoder(t)
+    return encoder(obj)
+
+
+def encode_list(obj: list | set) -> list:
+    # Fast path for lists of primitives
+    if all(type(item) in normal_types for item in obj):
+        return list(obj)
+    return [encode(item) for item in obj]
+
+
+def encode_dict(obj: dict) -> dict:
+    return {key: value if type(value) in normal_types else encode(value) for key, value in obj.items() if value is not None}
+
+
+def compile_encoder(t: type) -> Callable[[Any], Any]:
     if t == list or t == set:
-        return [encode(item) for item in obj]
+        return encode_list
 
     if t == dict:
-        return {key: encode(obj[key]) for key in obj if obj[key] is not None}
-    
+        return encode_dict
+
+    if issubclass(t, tuple) and hasattr(t, '_fields'):
+        # NamedTuple
+        fields = t._fields
+
+        def encode_named_tuple(obj):
+            return {key: value if type(value) in normal_types else encode(value) for key, value in zip(fields, obj) if value is not None}
+
+        return encode_named_tuple
+
+    names = slot_names(t)
+    if len(names) > 0:
+        return compile_slots_encoder(t, names)
+
     # python objects
-    try:
-        return {key: encode(getattr(obj, key)) for key in vars(obj) if getattr(obj, key) is not None}
-    except Exception as e:
-        raise Exception(f"Cannot serialize object of type '{t}': {obj}, {e}")
+    def encode_object(obj):
+        try:
+            return {key: value if type(value) in normal_types else encode(value) for key, value in vars(obj).items() if value is not None}
+        except Exception as e:
+            raise Exception(f"Cannot serialize object of type '{t}': {obj}, {e}")
+
+    return encode_object
+
+
+def slot_names(t: type) -> list[str]:
+    """Attribute names declared in __slots__ by a class and its bases."""
+    names = []
+    for klass in reversed(t.__mro__):
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots, )
+        for name in slots:
+            if name not in ('__dict__', '__weakref__') and name not in names:
+                names.append(name)
+    return names
+
+
+def compile_slots_encoder(t: type, names: list[str]) -> Callable[[Any], Any]:
+    # Instances still have a __dict__ if any class in the hierarchy doesn't declare __slots__
+    has_dict = any('__slots__' not in klass.__dict__ for klass in t.__mro__ if klass is not object)
+
+    def encode_slots(obj):
+        # Unset slots are skipped like None attributes
+        result = {name: value if type(value) in normal_types else encode(value)
+                  for name in names if (value := getattr(obj, name, None)) is not None}
+        if has_dict:
+            result.update((key, value if type(value) in normal_types else encode(value)) for key, value in vars(obj).items() if value is not None)
+        return result
+
+    return encode_slots
 
 
 def decode(obj: any, Class: Callable[[], T]) -> T:
     if Class is None or Class is Any or obj is None:
         return obj
-    
-    if isinstance(Class, types.UnionType):
-        for type_option in get_args(Class):
-            try:
-                return decode(obj, type_option)
-            except:
-                pass
-        raise Exception(f"Cannot denormalize '{obj}' to any type in Union '{Class}'")
 
-    t = type(obj)
+    return decoder(Class)(obj)
 
-    if Class == t:
-        return obj
-    
-    # We can convert integers to floats without loss of data
-    if Class == float and t == int:
-        return float(obj)
+
+def decode_many(rows: Iterable[Any], Class: Callable[[], T]) -> list[T]:
+    """Decode many objects to the same class, looking its decoder up once."""
+    if Class is None or Class is Any:
+        return list(rows)
+
+    decode_row = decoder(Class)
+    return [None if row is None else decode_row(row) for row in rows]
+
+
+def decoder(Class: Callable[[], T]) -> Callable[[Any], T]:
+    """The compiled decoder for a class or type hint. It expects a value that is not None."""
+    key = hint_key(Class)
+    try:
+        return decoders[key]
+    except KeyError:
+        decode_obj = decoders[key] = compile_decoder(Class)
+        return decode_obj
+    except TypeError:
+        # Unhashable type hint
+        return compile_decoder(Class)
+
+
+def hint_key(Class: Any) -> Any:
+    """A decoder cache key for a type hint. Unlike the hint, it depends on the order of union options."""
+    args = get_args(Class)
+    if len(args) == 0:
+        return Class
+    # With the types of the arguments, so that Literal[1] and Literal[True] differ too
+    return (get_origin(Class), tuple((type(arg), hint_key(arg)) for arg in args))
+
+
+def optional_decoder(Class: Any) -> Callable[[Any], Any]:
+    """A decoder that also accepts None, for values nested in containers and objects."""
+    if Class is None or Class is Any:
+        return identity
+
+    decode_obj = decoder(Class)
+    return lambda obj: None if obj is None else decode_obj(obj)
+
+
+def identity(obj: Any) -> Any:
+    return obj
+
+
+def compile_decoder(Class: Any) -> Callable[[Any], Any]:
+    origin = get_origin(Class)
+
+    if isinstance(Class, types.UnionType) or origin is Union:
+        return compile_union_decoder(Class)
+
+    if Class in normal_types:
+        return compile_primitive_decoder(Class)
 
     if Class == list:
-        return [item for item in obj]
-    
+        return list
+
     if Class == set:
-        return set([item for item in obj])
+        return set
 
     if Class == dict:
-        return {key: obj[key] for key in obj}
-    
-    if get_origin(Class) == Literal:
-        return obj
+        return dict
 
-    if get_origin(Class) == list:
-        assert(t == list)
-        type_args = get_args(Class)
-        
-        if len(type_args) == 0:
-            # No type arguments
-            return [item for item in obj]
+    if origin == Literal:
+        return identity
 
-        return [decode(item, type_args[0]) for item in obj]
-
-    if get_origin(Class) == set:
-        assert(t == list)
+    if origin == list or origin == set:
         type_args = get_args(Class)
-        
         if len(type_args) == 0:
             # No type arguments
-            return set([item for item in obj])
-
-        return set([decode(item, type_args[0]) for item in obj])
+            return origin
+        return compile_list_decoder(origin, type_args[0])
 
-    if get_origin(Class) == dict:
-        assert(t == dict)
+    if origin == dict:
         type_args = get_args(Class)
-        
         if len(type_args) == 0:
             # No type arguments
-            return {key: obj[key] for key in obj}
-        
+            return dict
         key_type, value_type = type_args
         assert(key_type == str)
-        value_type = type_args[1]
-        return {key: decode(obj[key], value_type) for key in obj}
+        return compile_dict_decoder(value_type)
 
-    # python objects
-    if t != dict:
-        raise Exception(f"Need a dict when denormalizing to class '{repr(Class)}', got '{t}': {obj}")
-    
-    kwargs = {}
-    for var_name, type_hint in get_type_hints(Class).items():
-        if var_name in obj:
-            kwargs[var_name] = decode(obj[var_name], type_hint)
-    return Class(**kwargs)
+    return compile_object_decoder(Class)
+
+
+def is_union(Class: Any) -> bool:
+    return isinstance(Class, types.UnionType) or get_origin(Class) is Union
+
+
+def union_options(Class: Any) -> list[Any]:
+    """The options of a union, with nested unions flattened and None left out."""
+    options = []
+    for option in get_args(Class):
+        if is_union(option):
+            options.extend(option for option in union_options(option) if option not in options)
+        elif option is not type(None) and option not in options:
+            options.append(option)
+    return options
+
+
+def json_types(Class: Any) -> tuple[type, ...] | None:
+    """The types of decoded JSON values a type hint accepts, or None if unknown."""
+    origin = get_origin(Class)
+    if Class is float:
+        return (float, int)
+    if Class in normal_types:
+        return (Class, )
+    if Class in (list, set) or origin in (list, set):
+        return (list, )
+    if Class == dict or origin == dict:
+        return (dict, )
+    if origin == Literal:
+        return tuple(set(type(value) for value in get_args(Class)))
+    if isinstance(Class, type) and origin is None:
+        # Objects are decoded from dicts, and passed through if already decoded
+        return (dict, Class)
+    return None
+
+
+def required_keys(Class: Any) -> frozenset[str] | None:
+    """The keys a dict must have to be decoded to a class, or None if unknown."""
+    if dataclasses.is_dataclass(Class):
+        return frozenset(field.name for field in dataclasses.fields(Class) if field.init
+                         and field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING)
+    if issubclass(Class, tuple) and hasattr(Class, '_fields'):
+        return frozenset(name for name in Class._fields if name not in Class._field_defaults)
+    try:
+        parameters = inspect.signature(Class).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    return frozenset(parameter.name for parameter in parameters if parameter.default is inspect.Parameter.empty
+                     and parameter.kind not in (inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.VAR_KEYWORD))
+
+
+def tag_field(classes: list[type]) -> tuple[str, dict[Any, type]] | None:
+    """A field that every class declares as a Literal with values no other class uses, and a map from its values to the classes."""
+    hints = [get_type_hints(Class) for Class in classes]
+    for name, hint in hints[0].items():
+        tags = {}
+        for Class, class_hints in zip(classes, hints):
+            class_hint = class_hints.get(name)
+            if get_origin(class_hint) != Literal or any(value in tags for value in get_args(class_hint)):
+                break
+            tags.update((value, Class) for value in get_args(class_hint))
+        else:
+            return name, tags
+    return None
+
+
+def compile_trial_decoder(Class: Any, options: list[Any]) -> Callable[[Any], Any]:
+    decoders = [(option, decoder(option)) for option in options]
+
+    def decode_trial(obj):
+        errors = []
+        for option, decode_option in decoders:
+            try:
+                return decode_option(obj)
+            except Exception as e:
+                errors.append(f'{option}: {e}')
+        raise Exception(f"Cannot denormalize '{obj}' to any type in Union '{Class}': {'; '.join(errors)}")
+
+    return decode_trial
+
+
+def compile_class_dispatch(Class: Any, classes: list[type]) -> Callable[[dict], Any]:
+    """Choose between classes for a dict by a tag field, or else by the keys each class requires."""
+    tag = tag_field(classes)
+    if tag is not None:
+        tag_name, tag_classes = tag
+        tag_decoders = {value: decoder(tag_class) for value, tag_class in tag_classes.items()}
+
+        def decode_tagged(obj):
+            decode_option = tag_decoders.get(obj.get(tag_name))
+            if decode_option is None:
+                raise Exception(f"Unknown '{tag_name}' {obj.get(tag_name)!r} when denormalizing to Union '{Class}': {obj}")
+            return decode_option(obj)
+
+        return decode_tagged
+
+    requirements = [(required_keys(option), option) for option in classes]
+    if any(required is None for required, _ in requirements):
+        return compile_trial_decoder(Class, classes)
+    # Most specific first, so the first match with no other match of the same size wins
+    requirements.sort(key=lambda item: len(item[0]), reverse=True)
+    option_decoders = {option: decoder(option) for option in classes}
+
+    def decode_by_keys(obj):
+        candidates = [(required, option) for required, option in requirements if required <= obj.keys()]
+        if len(candidates) == 0:
+            raise Exception(f"'{obj}' has the required keys of no type in Union '{Class}'")
+        if len(candidates) == 1 or len(candidates[0][0]) > len(candidates[1][0]):
+            return option_decoders[candidates[0][1]](obj)
+        return compile_trial_decoder(Class, [option for required, option in candidates if len(required) == len(candidates[0][0])])(obj)
+
+    return decode_by_keys
+
+
+def compile_union_decoder(Class: Any) -> Callable[[Any], Any]:
+    """Decode a union by dispatching on the JSON type of the value, then on tag fields or required keys.
+
+    Options are only tried one after the other when they can't be told apart up front.
+    """
+    # Built on the first decode, so unions can contain classes that refer to themselves
+    dispatch: dict[type, Callable[[Any], Any]] | None = None
+    fallback: Callable[[Any], Any] | None = None
+
+    def build():
+        nonlocal dispatch, fallback
+        options = union_options(Class)
+        by_type: dict[type, list[Any]] = {}
+        unknown = []
+        for option in options:
+            accepted = json_types(option) if option is not Any else None
+            if accepted is None:
+                unknown.append(option)
+                continue
+            for json_type in accepted:
+                by_type.setdefault(json_type, []).append(option)
+
+        table = {}
+        for json_type, type_options in by_type.items():
+            candidates = type_options + [option for option in unknown if option not in type_options]
+            classes = [option for option in candidates if isinstance(option, type) and get_origin(option) is None and option not in normal_types
+                       and option not in (list, set, dict)]
+            if len(candidates) == 1:
+                table[json_type] = decoder(candidates[0])
+            elif json_type is dict and len(classes) == len(candidates):
+                table[json_type] = compile_class_dispatch(Class, classes)
+            else:
+                table[json_type] = compile_trial_decoder(Class, candidates)
+
+        fallback = compile_trial_decoder(Class, unknown) if len(unknown) > 0 else None
+        dispatch = table
+
+    def decode_union(obj):
+        if dispatch is None:
+            build()
+        decode_option = dispatch.get(type(obj), fallback)
+        if decode_option is None:
+            raise Exception(f"Cannot denormalize '{obj}' to any type in Union '{Class}'")
+        return decode_option(obj)
+
+    return decode_union
+
+
+def compile_primitive_decoder(Class: type) -> Callable[[Any], Any]:
+    def decode_primitive(obj):
+        t = type(obj)
+        if t is Class:
+            return obj
+
+        # We can convert integers to floats without loss of data
+        if Class is float and t is int:
+            return float(obj)
+
+        raise Exception(f"Need a '{Class.__name__}' when denormalizing, got '{t}': {obj}")
+
+    return decode_primitive
+
+
+def compile_list_decoder(container: type, item_type: Any) -> Callable[[Any], Any]:
+    decode_item = optional_decoder(item_type)
+
+    if item_type in normal_types and item_type is not float:
+        # Fast path for lists of primitives: check the types, then copy
+        def decode_primitive_list(obj):
+            assert(type(obj) == list)
+            if all(type(item) is item_type for item in obj):
+                return container(obj)
+            return container([decode_item(item) for item in obj])
+
+        return decode_primitive_list
+
+    def decode_list(obj):
+        assert(type(obj) == list)
+        return container([decode_item(item) for item in obj])
+
+    return decode_list
+
+
+def compile_dict_decoder(value_type: Any) -> Callable[[Any], Any]:
+    decode_value = optional_decoder(value_type)
+
+    if value_type in normal_types and value_type is not float:
+        # Fast path for dicts of primitives
+        def decode_primitive_dict(obj):
+            assert(type(obj) == dict)
+            if all(type(value) is value_type for value in obj.values()):
+                return dict(obj)
+            return {key: decode_value(value) for key, value in obj.items()}
+
+        return decode_primitive_dict
+
+    def decode_dict(obj):
+        assert(type(obj) == dict)
+        return {key: decode_value(value) for key, value in obj.items()}
+
+    return decode_dict
+
+
+def compile_object_decoder(Class: Callable[[], T]) -> Callable[[Any], T]:
+    # Field decoders are built on the first decode, so classes can refer to themselves
+    # (name, the primitive type that is used as is, decoder)
+    fields: list[tuple[str, type | None, Callable[[Any], Any]]] | None = None
+
+    def decode_object(obj):
+        nonlocal fields
+        t = type(obj)
+
+        if t is Class:
+            return obj
+
+        # python objects
+        if t != dict:
+            raise Exception(f"Need a dict when denormalizing to class '{repr(Class)}', got '{t}': {obj}")
+
+        if fields is None:
+            fields = [(var_name, type_hint if type_hint in normal_types else None, optional_decoder(type_hint))
+                      for var_name, type_hint in get_type_hints(Class).items()]
+
+        kwargs = {}
+        for var_name, exact_type, decode_field in fields:
+            if var_name in obj:
+                value = obj[var_name]
+                kwargs[var_name] = value if type(value) is exact_type else decode_field(value)
+        return Class(**kwargs)
 
+    return decode_object
@@ -1,19 +1,109 @@
 import requests
-from typing import Dict
+from requests.adapters import HTTPAdapter
+import http.cookiejar
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict, Iterable, Iterator
+
+# Connections kept alive per host by the shared session
+POOL_SIZE = 32
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """The keep-alive session shared by every fetch, created on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            # Only connections are shared: cookies set by one response are not sent with later requests
+            _session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
 
 
 def fetch(url: str, options: Dict[str, any]={}) -> requests.Response:
     """Fetch a url with JS-like syntax.
 
+    Connections are reused between calls, from any thread.
+
     Args:
         url (str): URL to fetch
         options (Dict[str, any]): Fetch options, including method, headers, and body.
+            With 'stream': True the body is not read until it is used, see iter_body.
 
     Returns:
-        _type_: _description_
+        requests.Response: The response, whatever its status code.
     """
-    return requests.request(method=options.get('method', 'GET'), 
+    return get_session().request(method=options.get('method', 'GET'),
         url=url,
         headers=options.get('headers', {}),
-        data=options.get('body', None)
+        data=options.get('body', None),
+        stream=options.get('stream', False)
         )
+
+
+def iter_body(response: requests.Response, chunk_size: int=64 * 1024) -> Iterator[bytes]:
+    """Iterate over a response body in chunks, e.g. of fetch(url, {'stream': True}).
+
+    The connection goes back to the pool when the body is consumed or the iteration is stopped.
+    """
+    with response:
+        yield from response.iter_content(chunk_size)
+
+
+def fetch_many(urls_or_requests: Iterable[str | tuple[str, Dict[str, any]]], concurrency: int=8, ordered: bool=True,
+               return_exceptions: bool=False) -> Iterator[tuple[int, requests.Response | Exception]]:
+    """Fetch many urls concurrently, yielding (index, response) pairs.
+
+    Requests are read lazily from the iterable and at most `concurrency` are in flight.
+
+    Args:
+        urls_or_requests (Iterable): URLs, or (url, options) tuples as for fetch.
+        concurrency (int): Number of requests sent at the same time. Defaults to 8.
+        ordered (bool): Yield in input order, otherwise in completion order. Defaults to True.
+        return_exceptions (bool): Yield a failed request's exception instead of raising it. Defaults to False.
+    """
+    requests_iter = enumerate(urls_or_requests)
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fetch')
+    in_flight: deque[tuple[int, Future]] = deque()
+
+    def submit_next() -> bool:
+        item = next(requests_iter, None)
+        if item is None:
+            return False
+        index, request = item
+        url, options = (request, {}) if isinstance(request, str) else request
+        in_flight.append((index, executor.submit(fetch, url, options)))
+        return True
+
+    def outcome(future: Future) -> requests.Response | Exception:
+        if return_exceptions and future.exception() is not None:
+            return future.exception()
+        return future.result()
+
+    try:
+        while len(in_flight) < concurrency and submit_next():
+            pass
+
+        while len(in_flight) > 0:
+            if ordered:
+                index, future = in_flight.popleft()
+                yield index, outcome(future)
+                submit_next()
+                continue
+
+            wait([future for _, future in in_flight], return_when=FIRST_COMPLETED)
+            done = [(index, future) for index, future in in_flight if future.done()]
+            for index, future in done:
+                in_flight.remove((index, future))
+            for index, future in done:
+                yield index, outcome(future)
+                submit_next()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -1,6 +1,14 @@
 import coolpy.coding as coding
-from typing import Any, Generic, Callable, Union, TypeVar
+from typing import Any, Generic, Callable, Iterable, Iterator, Union, TypeVar
+import atexit
+import codecs
+import hashlib
 import json
+import os
+import stat
+import tempfile
+import threading
+import weakref
 
 T = TypeVar('T')
 
@@ -20,22 +28,220 @@ def load(fp, Class: Callable[[], T], **kwargs) -> T:
     return coding.decode(json.load(fp, **kwargs), Class)
 
 
+def loads_many(strings: Iterable[Union[str, bytes, bytearray]], Class: Callable[[], T], **kwargs) -> list[T]:
+    """Parse and decode many JSON documents to the same class."""
+    return coding.decode_many([json.loads(s, **kwargs) for s in strings], Class)
+
+
+def iter_load(fp, Class: Callable[[], T], lines: bool | None = None, chunk_size: int = 64 * 1024, **kwargs) -> Iterator[T]:
+    """Decode the records of a JSON Lines file, or the items of a top-level JSON array, one at a time.
+
+    The file is read `chunk_size` characters at a time, so memory use doesn't grow with its size.
+    With `lines=None` a file starting with '[' is read as an array; pass `lines=True` for
+    JSON Lines files whose records are arrays. kwargs are passed to json.JSONDecoder.
+    """
+    decoder = json.JSONDecoder(**kwargs)
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def fill(size: int = chunk_size) -> bool:
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        chunk = fp.read(size)
+        if isinstance(chunk, bytes):
+            chunk = text_decoder.decode(chunk, final=len(chunk) == 0)
+        eof = len(chunk) == 0
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return not eof
+
+    def next_char() -> str:
+        # The next non-whitespace character, or '' at the end of the file
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return buffer[pos:pos + 1]
+
+    in_array = next_char() == '[' if lines is None else not lines
+    if in_array:
+        if next_char() != '[':
+            raise json.JSONDecodeError("Expecting '['", buffer, pos)
+        pos += 1
+    first = True
+
+    while True:
+        char = next_char()
+        if char == '':
+            if in_array:
+                raise json.JSONDecodeError('Unterminated array', buffer, pos)
+            return
+        if in_array and char == ']':
+            return
+        if in_array and not first:
+            if char != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+            pos += 1
+            next_char()
+        first = False
+
+        # A record larger than the buffer is retried after reads that double in size,
+        # so the attempts take time linear in its size
+        read_size = chunk_size
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(buffer) or eof:
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill(read_size)
+            read_size *= 2
+
+        pos = end
+        yield coding.decode(obj, Class)
+
+
+def dump_iter(iterable: Iterable[Any], fp, lines: bool = True, **kwargs) -> int:
+    """Encode and write objects one at a time, as JSON Lines or as a top-level JSON array.
+
+    Returns the number of objects written. kwargs are passed to json.dumps.
+    """
+    count = 0
+    if not lines:
+        fp.write('[')
+
+    for obj in iterable:
+        if lines:
+            fp.write(json.dumps(coding.encode(obj), **kwargs))
+            fp.write('\n')
+        else:
+            fp.write(',\n' if count > 0 else '\n')
+            fp.write(json.dumps(coding.encode(obj), **kwargs))
+        count += 1
+
+    if not lines:
+        fp.write('\n]\n')
+    return count
+
+
+def current_umask() -> int:
+    """The process umask, which can only be read by setting it."""
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
 class JSONFile(Generic[T]):
+    """JSON file contents decoded to a class, saved back with save().
+
+    Saves are skipped when the encoded contents haven't changed since the
+    last load or save, and are written to a temporary file that is renamed
+    over the original, so a crash never leaves a truncated file. With
+    `save_interval`, save() only schedules a write that happens that many
+    seconds later, when flush() is called, when the file is used as a
+    context manager and the block exits, or at interpreter exit.
+
+    A file that exists but can't be parsed raises rather than being replaced.
+    """
     filename: str
     contents: T
     minify: bool = False
+    save_interval: float | None = None
+
+    digest: bytes | None
+    save_timer: threading.Timer | None
+    lock: threading.RLock
+
+    _open_files: 'weakref.WeakSet[JSONFile]' = weakref.WeakSet()
 
-    def __init__(self, filename: str, Class: Callable[[], T], minify: bool = False):
+    def __init__(self, filename: str, Class: Callable[[], T], minify: bool = False, save_interval: float | None = None):
         self.filename = filename
         self.minify = minify
-        
+        self.save_interval = save_interval
+        self.digest = None
+        self.save_timer = None
+        self.lock = threading.RLock()
+
         try:
-            self.contents = load(open(filename, 'r'), Class)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
+            with open(filename, 'r') as f:
+                text = f.read()
+        except FileNotFoundError:
             self.contents = Class()
+        else:
+            self.contents = loads(text, Class)
+            self.digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
 
-    def save(self):
+        JSONFile._open_files.add(self)
+
+    def __enter__(self) -> 'JSONFile[T]':
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+    def dumps(self) -> str:
         if self.minify:
-            dump(self.contents, open(self.filename, 'w'), separators=(',', ':'))
-        else:
-            dump(self.contents, open(self.filename, 'w'), indent=4, sort_keys=True)
+            return dumps(self.contents, separators=(',', ':'))
+        return dumps(self.contents, indent=4, sort_keys=True)
+
+    def save(self):
+        """Save the contents, or schedule a save when there is a save_interval."""
+        with self.lock:
+            if self.save_interval is None:
+                self.write()
+            elif self.save_timer is None:
+                self.save_timer = threading.Timer(self.save_interval, self.flush)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def flush(self):
+        """Write a scheduled save now."""
+        with self.lock:
+            if self.save_timer is None:
+                return
+            self.save_timer.cancel()
+            self.save_timer = None
+            self.write()
+
+    def write(self) -> bool:
+        """Write the contents if they changed. Returns whether the file was written."""
+        with self.lock:
+            text = self.dumps()
+            digest = hashlib.blake2b(text.encode(), digest_size=16).digest()
+            if digest == self.digest:
+                return False
+
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(self.filename)}.', suffix='.tmp')
+            try:
+                try:
+                    os.chmod(temp_path, stat.S_IMODE(os.stat(self.filename).st_mode))
+                except FileNotFoundError:
+                    # The mode open(filename, 'w') would have created the file with
+                    os.chmod(temp_path, 0o666 & ~current_umask())
+                with os.fdopen(fd, 'w') as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.filename)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+            self.digest = digest
+            return True
+
+    @classmethod
+    def flush_all(cls):
+        for json_file in list(cls._open_files):
+            json_file.flush()
+
+
+atexit.register(JSONFile.flush_all)
@@ -2,7 +2,8 @@ import os
 import traceback
 import types
 import coolpy.json as json
-from typing import Callable, TypeVar
+from typing import Callable, Iterable, TypeVar
+import itertools
 import sqlite3
 import logging
 
@@ -15,7 +16,6 @@ import logging
 # Support deleting items
 
 
-logging.basicConfig(level=logging.INFO)
 l = logging.getLogger(__name__)
 
 
@@ -78,6 +78,11 @@ def index_name(key_path: str) -> str:
     return f'index_{table_name(key_path)}'
 
 
+def json_path(key_path: str) -> str:
+    """The SQLite JSON path of a key path, e.g. 'd.x' -> '$."d"."x"'."""
+    return '$' + ''.join(f'."{key}"' for key in key_path.split('.'))
+
+
 class Transaction:
     db: sqlite3.Connection
 
@@ -105,6 +110,7 @@ class JsonDB:
     def __init__(self, path: str, Class: Callable[[], T], overwrite: bool = False):
         self.path = path
         self.Class = Class
+        self.indices = set()
 
         if overwrite:
             try:
@@ -137,7 +143,52 @@ class JsonDB:
         for key_path in self.indices:
             self._update_index(key_path, obj, data_id)
 
-    
+
+    def insert_many(self, objs: Iterable[T], chunk_size: int = 10000) -> int:
+        """Insert many objects in one transaction, returning how many were inserted.
+
+        Rows are written with executemany, `chunk_size` at a time, and the
+        indices are brought up to date once at the end, with one set-based
+        statement per index instead of statements per object. If objs or
+        encoding raise, the transaction is rolled back, along with any other
+        uncommitted changes, and the exception is re-raised.
+        """
+        count = 0
+        objs = iter(objs)
+
+        # Commits, or rolls back and re-raises, so the caller sees errors from objs and encoding
+        with self.conn:
+            last_id = self.conn.execute('SELECT coalesce(max(data_id), 0) FROM data').fetchone()[0]
+
+            while True:
+                chunk = [(json.dumps(obj),) for obj in itertools.islice(objs, chunk_size)]
+                if len(chunk) == 0:
+                    break
+                self.conn.executemany('INSERT INTO data (json) VALUES (?)', chunk)
+                count += len(chunk)
+
+            for key_path in self.indices:
+                self._index_rows(key_path, last_id)
+
+        return count
+
+
+    def _index_rows(self, key_path: str, after_id: int = 0):
+        """Index the rows with data_id > after_id, from their JSON with SQLite's JSON functions."""
+        tbl_name = table_name(key_path)
+        path = json_path(key_path)
+
+        # Arrays (lists and sets) are indexed by each of their items, like _update_index does
+        self.conn.execute(f'''
+            INSERT OR REPLACE INTO {tbl_name} (data_id, {tbl_name})
+            SELECT data.data_id, item.value FROM data, json_each(data.json, ?) AS item
+            WHERE data.data_id > ? AND json_type(data.json, ?) = 'array' AND item.type NOT IN ('array', 'object', 'null')
+            UNION ALL
+            SELECT data_id, json_extract(json, ?) FROM data
+            WHERE data_id > ? AND json_type(json, ?) NOT IN ('array', 'object', 'null')
+        ''', (path, after_id, path, path, after_id, path))
+
+
     def _replace(self, obj: T, data_id: int):
         s = json.dumps(obj)
         self.conn.execute('UPDATE data SET json = ? WHERE data_id = ?', (s, data_id))
@@ -161,10 +212,11 @@ class JsonDB:
             self._replace(obj, data_id)
 
     
-    def upsert(self, obj: T, key_path: str, update_func: Callable[[T, T], T] = None):
+    def upsert(self, obj: T, key_path: str, update_func: Callable[[T, T], T] = None, merge_strategies: dict | None = None):
         if update_func is None:
             import coolpy.merge
-            update_func = coolpy.merge.merge
+            # The existing object was just decoded, so it can be merged into in place
+            update_func = lambda existing_obj, obj: coolpy.merge.merge(existing_obj, obj, strategies=merge_strategies)
 
         self.add_index(key_path)
 
@@ -243,22 +295,12 @@ class JsonDB:
             l.debug(f"Creating index table with command: {cmd}")
             self.conn.execute(cmd)
 
+            # Fill the table before indexing it, so the indexes are built in one pass
+            self._index_rows(key_path)
+
             self.conn.execute(f'CREATE INDEX IF NOT EXISTS {idx_name} ON {tbl_name} ({tbl_name})')
             self.conn.execute(f'CREATE INDEX IF NOT EXISTS {tbl_name}_data_id ON {tbl_name} (data_id)')
 
-            cursor = self.conn.execute('SELECT data_id, json FROM data')
-            index = 0
-            for row in cursor.fetchall():
-                data_id = row[0]
-                obj = json.loads(row[1], self.Class)
-
-                self._update_index(key_path, obj, data_id)
-
-                index += 1
-
-                if index % 100000 == 0:
-                    l.info(f"Indexed {index} rows for key path '{key_path}'")
-
         self.indices.add(key_path)
 
 
@@ -269,13 +311,16 @@ class JsonDB:
 
         tbl_name = table_name(key_path)
         cursor = self.conn.execute(f'SELECT json FROM data NATURAL JOIN {tbl_name} WHERE {tbl_name} is ?', (value,))
-        return [json.loads(row[0], self.Class) for row in cursor.fetchall()]
+        return json.loads_many([row[0] for row in cursor.fetchall()], self.Class)
 
 
-    def load_all(self, sql: str=''):
+    def load_all(self, sql: str='', batch_size: int=1000):
         cursor = self.conn.execute(f'SELECT json FROM data {sql}')
-        for row in cursor:
-            yield json.loads(row[0], self.Class)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            yield from json.loads_many([row[0] for row in rows], self.Class)
 
     def close(self):
         self.conn.commit()
@@ -1,41 +1,228 @@
 """Merge objects, lists, sets, and dicts recursively."""
+import copy as copy_module
+from typing import Any, NamedTuple
 
-def merge(*objs):
-    """Merge multiple objects into one. Later objects override earlier ones."""
-    result = None
-    for obj in objs:
-        if obj is None:
-            continue
+APPEND = 'append'
+REPLACE = 'replace'
+UNION = 'union'
+MERGE = 'merge'
+
+
+class ByKey(NamedTuple):
+    """Strategy for lists of records: items with the same `field` value are merged, others appended."""
+    field: str
+
+
+primitive_types = (int, float, str, bool)
+
+
+def merge(*objs, strategies: dict[str | type, str | ByKey] | None = None, copy: bool = False):
+    """Merge multiple objects into one. Later objects override earlier ones.
+
+    Lists are appended, sets joined, and dicts and objects merged field by
+    field, unless `strategies` says otherwise. Its keys are dotted field paths
+    such as 'tags' or 'author.links' (list items don't add a path segment),
+    or types, and its values are APPEND, REPLACE, UNION, MERGE or ByKey(field).
+    MERGE merges list items position by position, and joins sets like UNION.
+    UNION and ByKey compare unhashable items and keys, such as dicts, by value.
+
+    The fold takes time linear in the total size of the objects.
+
+    Args:
+        objs: The objects to merge. None is skipped.
+        strategies (dict, optional): Merge strategies by field path or type.
+        copy (bool, optional): If False, the first object is updated in place and returned.
+            If True, no argument is changed: containers are copied only where they change,
+            and the result shares everything else with the arguments.
+    """
+    return Merger(strategies or {}, copy).fold(objs)
+
+
+class Merger:
+    strategies: dict[str | type, str | ByKey]
+    in_place: bool
+    created: set[int]
+    shared: set[int]
+    indexes: dict[int, dict]
+    keep: list
 
-        if result is None:
-            result = obj
-            continue
+    def __init__(self, strategies: dict[str | type, str | ByKey], copy: bool):
+        self.strategies = strategies
+        self.in_place = not copy
+        # ids of containers the merger made, and of containers taken over from arguments other
+        # than the first; `keep` holds on to them so their ids aren't reused
+        self.created = set()
+        self.shared = set()
+        self.indexes = {}
+        self.keep = []
 
-        if type(result) != type(obj):
-            result = obj
-            continue
 
-        if isinstance(obj, (int, float, str, bool)):
-            result = obj
-            continue
+    def fold(self, objs: tuple) -> Any:
+        result = None
+        for obj in objs:
+            if obj is None:
+                continue
+            if result is None and self.in_place:
+                result = obj
+                continue
+            result = self.merge(result, obj, '')
+        return result
+
+
+    def strategy(self, path: str, t: type) -> str | ByKey | None:
+        strategy = self.strategies.get(path[1:])
+        if strategy is None:
+            strategy = self.strategies.get(t)
+        return strategy
+
+
+    def adopt(self, obj: Any) -> Any:
+        """Take a value from an argument as is. It is copied before it is ever changed."""
+        if not isinstance(obj, primitive_types) and obj is not None:
+            self.shared.add(id(obj))
+            self.keep.append(obj)
+        return obj
+
+
+    def writable(self, obj: Any) -> Any:
+        """obj itself if the merger may change it, otherwise a shallow copy whose children are shared."""
+        if id(obj) in self.created or (self.in_place and id(obj) not in self.shared):
+            return obj
+
+        if isinstance(obj, dict):
+            result = dict(obj)
+            children = result.values()
+        elif isinstance(obj, (list, set)):
+            result = type(obj)(obj)
+            children = result
+        else:
+            result = copy_module.copy(obj)
+            children = vars(result).values()
+
+        for child in children:
+            self.adopt(child)
+        self.created.add(id(result))
+        self.keep.append(result)
+        return result
+
+
+    def merge(self, result: Any, obj: Any, path: str) -> Any:
+        if obj is None:
+            return result
+
+        if result is None or type(result) != type(obj) or isinstance(obj, primitive_types):
+            return self.adopt(obj)
+
+        strategy = self.strategy(path, type(obj))
+        if strategy == REPLACE:
+            return self.adopt(obj)
 
         if isinstance(obj, list):
-            result = result + obj
-        elif isinstance(obj, set):
-            result = result.union(obj)
-        elif isinstance(obj, dict):
-            for key in obj:
-                if key in result:
-                    result[key] = merge(result[key], obj[key])
+            return self.merge_list(result, obj, path, strategy or APPEND)
+
+        if isinstance(obj, set):
+            if strategy == APPEND or strategy == UNION or strategy == MERGE or strategy is None:
+                result = self.writable(result)
+                result.update(obj)
+                return result
+            raise ValueError(f"Can't merge sets at '{path[1:]}' with strategy {strategy}")
+
+        if isinstance(obj, dict):
+            result = self.writable(result)
+            for key, value in obj.items():
+                result[key] = self.merge(result.get(key), value, f'{path}.{key}')
+            return result
+
+        result = self.writable(result)
+        for name, value in vars(obj).items():
+            name: str
+            if name.startswith('_'):
+                continue
+
+            setattr(result, name, self.merge(getattr(result, name, None), value, f'{path}.{name}'))
+        return result
+
+
+    def merge_list(self, result: list, obj: list, path: str, strategy: str | ByKey) -> list:
+        result = self.writable(result)
+        # obj may be result itself, which grows below
+        items = list(obj)
+
+        if strategy == APPEND:
+            result.extend(self.adopt(item) for item in items)
+            return result
+
+        if strategy == MERGE:
+            for position, item in enumerate(items):
+                if position < len(result):
+                    result[position] = self.merge(result[position], item, path)
                 else:
-                    result[key] = obj[key]
-        else:
-            for name in vars(obj):
-                name: str
-                if name.startswith('_'):
-                    continue
+                    result.append(self.adopt(item))
+            return result
+
+        if strategy == UNION:
+            seen = self.index(result, None)
+            for item in items:
+                key = hash_key(item)
+                if key not in seen:
+                    seen[key] = len(result)
+                    result.append(self.adopt(item))
+            return result
+
+        if isinstance(strategy, ByKey):
+            positions = self.index(result, strategy.field)
+            for item in items:
+                key = hash_key(item_key(item, strategy.field))
+                position = positions.get(key) if key is not None else None
+                if position is None:
+                    if key is not None:
+                        positions[key] = len(result)
+                    result.append(self.adopt(item))
+                else:
+                    result[position] = self.merge(result[position], item, path)
+            return result
+
+        raise ValueError(f"Can't merge lists at '{path[1:]}' with strategy {strategy}")
+
+
+    def index(self, result: list, field: str | None) -> dict:
+        """Positions of a list's items, or of their `field` values, kept up to date for the whole fold."""
+        index = self.indexes.get(id(result))
+        if index is None:
+            index = self.indexes[id(result)] = {}
+            for position, item in enumerate(result):
+                key = hash_key(item if field is None else item_key(item, field))
+                if key is not None:
+                    index.setdefault(key, position)
+        return index
+
+
+def item_key(item: Any, field: str) -> Any:
+    if isinstance(item, dict):
+        return item.get(field)
+    return getattr(item, field, None)
+
+
+# Tags the stand-ins of unhashable values, so they never equal a hashable item
+_unhashable = object()
+
+
+def hash_key(value: Any) -> Any:
+    """value itself if it is hashable, otherwise a hashable stand-in that is equal for equal values."""
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return canonical(value)
 
-                setattr(result, name,
-                        merge(getattr(result, name, None), getattr(obj, name, None)))
 
-    return result
+def canonical(value: Any) -> Any:
+    if isinstance(value, dict):
+        return (_unhashable, dict, frozenset((key, hash_key(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (_unhashable, type(value), tuple(hash_key(item) for item in value))
+    if isinstance(value, set):
+        return (_unhashable, set, frozenset(value))
+    if hasattr(value, '__dict__'):
+        return (_unhashable, type(value), hash_key(vars(value)))
+    raise TypeError(f"Can't compare items of type {type(value).__name__} by value")
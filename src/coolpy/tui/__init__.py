@@ -1,4 +1,7 @@
+import sys
+import threading
 import time
+from typing import *
 
 
 def color_text(text: str, color: str) -> str:
@@ -38,17 +41,224 @@ class StatusBar:
 
 
     def print_status(self, current_unit: int):
-        if time.time() - self.last_update_time < self.update_interval:
+        now = time.time()
+        if now - self.last_update_time < self.update_interval:
             return
 
         percentage = (current_unit / self.total_units) * 100
-        elapsed_time = time.time() - self.start_time
+        elapsed_time = now - self.start_time
         remaining_time = (elapsed_time / current_unit) * (self.total_units - current_unit) if current_unit > 0 else 0
         print(f"\rProgress: {percentage:3.2f}% ({current_unit}/{self.total_units})"
               f" - Elapsed Time: {pretty_time_string(elapsed_time)} - Remaining Time: {pretty_time_string(remaining_time)}", end="")
-        self.last_update_time = time.time()
+        self.last_update_time = now
 
 
     def finish(self):
         total_time = time.time() - self.start_time
         print(color_text(f"\n==> Completed {self.total_units} items in {total_time:5.2f} seconds.", 'green'))
+
+
+class ProgressBar:
+    """One named bar of a Progress. update() only increments a counter, drawing is done by the Progress."""
+    name: str
+    total: int | None
+    count: int
+    lock: threading.Lock
+    # Counter updated by process pool workers, see Progress.pool_options
+    shared: Any = None
+
+    start_time: float
+    last_time: float
+    last_count: int
+    rate: float | None
+
+    def __init__(self, name: str, total: int | None = None):
+        self.name = name
+        self.total = total
+        self.count = 0
+        self.lock = threading.Lock()
+        self.start_time = self.last_time = time.monotonic()
+        self.last_count = 0
+        self.rate = None
+
+
+    def update(self, n: int = 1):
+        with self.lock:
+            self.count += n
+
+
+    def track(self, futures: Iterable[Any]):
+        """Count futures (e.g. from a thread or process pool) as they finish."""
+        for future in futures:
+            future.add_done_callback(lambda _: self.update())
+
+
+    def completed(self) -> int:
+        if self.shared is None:
+            return self.count
+        return self.count + self.shared.value
+
+
+    def sample(self, now: float, smoothing: float) -> int:
+        """Update the items/sec EWMA and return the current count."""
+        count = self.completed()
+        elapsed = now - self.last_time
+        if elapsed > 0:
+            rate = (count - self.last_count) / elapsed
+            self.rate = rate if self.rate is None else smoothing * rate + (1 - smoothing) * self.rate
+            self.last_time = now
+            self.last_count = count
+        return count
+
+
+    def line(self, count: int, now: float, width: int = 30) -> str:
+        rate = self.rate or 0.0
+        elapsed = pretty_time_string(now - self.start_time)
+        if self.total is None or self.total <= 0:
+            return f"{self.name}: {count} - {rate:.1f}/s - Elapsed Time: {elapsed}"
+
+        fraction = min(count / self.total, 1.0)
+        filled = int(fraction * width)
+        eta = pretty_time_string((self.total - count) / rate) if rate > 0 else '--:--:--'
+        return (f"{self.name}: [{'#' * filled}{'.' * (width - filled)}] {fraction * 100:5.1f}% ({count}/{self.total})"
+                f" - {rate:.1f}/s - Elapsed Time: {elapsed} - Remaining Time: {eta}")
+
+
+class WorkerProgressBar:
+    """The side of a ProgressBar seen by process pool workers."""
+    name: str
+    shared: Any
+
+    def __init__(self, name: str, shared: Any):
+        self.name = name
+        self.shared = shared
+
+
+    def update(self, n: int = 1):
+        with self.shared.get_lock():
+            self.shared.value += n
+
+
+_active_progress: list['Progress'] = []
+_worker_bars: dict[str, WorkerProgressBar] = {}
+
+
+def progress_bar(name: str) -> ProgressBar | WorkerProgressBar:
+    """The bar with this name in the current Progress, also in process pool workers set up with pool_options."""
+    # Checked first: forked workers also inherit a copy of the parent's Progress
+    if name in _worker_bars:
+        return _worker_bars[name]
+    for progress in reversed(_active_progress):
+        bar = progress.bars.get(name)
+        if bar is not None:
+            return bar
+    raise KeyError(name)
+
+
+def init_progress_worker(shared: dict[str, Any]):
+    _worker_bars.update((name, WorkerProgressBar(name, value)) for name, value in shared.items())
+
+
+class Progress:
+    """Several named progress bars, drawn by a background thread.
+
+    Bars are updated from any thread with `bar.update()`, which only takes a
+    lock and increments a counter. Every `refresh_interval` seconds a single
+    render thread redraws all bars in place, with items/sec smoothed by an
+    exponentially weighted moving average and the remaining time based on
+    it. When the stream is not a terminal, one line per bar is printed every
+    `log_interval` seconds instead.
+
+    Process pool workers can update bars too, when the pool is created with
+    `**progress.pool_options()`, through `progress_bar(name).update()`.
+
+        with Progress() as progress:
+            bar = progress.add('pages', total=len(urls))
+            for url in urls:
+                ...
+                bar.update()
+    """
+    bars: dict[str, ProgressBar]
+    stream: TextIO
+    is_tty: bool
+    interval: float
+    smoothing: float
+
+    lines_drawn: int
+    thread: threading.Thread | None
+    stopped: threading.Event
+    lock: threading.Lock
+
+    def __init__(self, stream: TextIO | None = None, refresh_interval: float = 0.2, log_interval: float = 10.0, smoothing: float = 0.3):
+        self.bars = {}
+        self.stream = stream if stream is not None else sys.stdout
+        self.is_tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.interval = refresh_interval if self.is_tty else log_interval
+        self.smoothing = smoothing
+        self.lines_drawn = 0
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+
+    def add(self, name: str, total: int | None = None) -> ProgressBar:
+        with self.lock:
+            bar = self.bars[name] = ProgressBar(name, total)
+        return bar
+
+
+    def pool_options(self) -> dict[str, Any]:
+        """initializer and initargs for a ProcessPoolExecutor or multiprocessing.Pool whose workers update the bars."""
+        import multiprocessing
+
+        with self.lock:
+            for bar in self.bars.values():
+                if bar.shared is None:
+                    bar.shared = multiprocessing.Value('q', 0)
+            shared = {name: bar.shared for name, bar in self.bars.items()}
+        return {'initializer': init_progress_worker, 'initargs': (shared, )}
+
+
+    def start(self) -> 'Progress':
+        _active_progress.append(self)
+        self.thread = threading.Thread(target=self.run, name='progress', daemon=True)
+        self.thread.start()
+        return self
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.render()
+
+
+    def render(self):
+        now = time.monotonic()
+        with self.lock:
+            lines = [bar.line(bar.sample(now, self.smoothing), now) for bar in self.bars.values()]
+
+        if self.is_tty:
+            # Move back up over the previous frame and redraw it
+            up = f"\033[{self.lines_drawn}F" if self.lines_drawn > 0 else ''
+            self.stream.write(up + ''.join(f"{line}\033[K\n" for line in lines))
+            self.lines_drawn = len(lines)
+        elif len(lines) > 0:
+            self.stream.write(''.join(f"{line}\n" for line in lines))
+        self.stream.flush()
+
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        _active_progress.remove(self)
+        self.render()
+
+
+    def __enter__(self) -> 'Progress':
+        return self.start()
+
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
@@ -1,15 +1,29 @@
 from urllib.parse import unquote_plus
-from coolpy.caching import CachedRequests
 import json
 import logging
-import PIL.Image
-from PIL.Image import Image
-from typing import overload
-from .Wikicode import Wikicode, Template
+from typing import overload, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from PIL.Image import Image
+    from coolpy.caching import CachedRequests
+    from .Wikicode import Wikicode, Template
 
-logging.basicConfig(level=logging.INFO)
 l = logging.getLogger(__name__)
 
+
+def import_wikicode():
+    """Import Wikicode and Template, which need mwparserfromhell, on first use."""
+    # Bound after the import, so the names refer to the classes rather than the submodule
+    global Wikicode, Template
+    from .Wikicode import Wikicode, Template
+
+
+def __getattr__(name: str):
+    if name in ('Wikicode', 'Template'):
+        import_wikicode()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 BATCH_SIZE = 15
 
 class Wikipedia:
@@ -19,10 +33,11 @@ class Wikipedia:
     HEADERS = {
         'User-Agent': 'CoolpyWikipediaBot/0.1.0 (https://www.sanvillesoftware.com; edsanville@gmail.com) coolpy/0.1.0'
     }
-    session: CachedRequests
+    session: 'CachedRequests'
 
     def __init__(self, expiration_days: int = 30, throttle_seconds: float = 1.0):
-        self.session = CachedRequests(expiration_days=expiration_days, throttle_seconds=throttle_seconds)
+        from coolpy.caching import CachedRequests
+        self.session = CachedRequests(expiration_days=expiration_days, throttle_seconds=throttle_seconds, revalidate=True, list_separator='|')
         l.debug(f'Initialized Wikipedia session with expiration_days={expiration_days} and throttle_seconds={throttle_seconds}')
 
     def query(self, params: dict) -> dict:
@@ -35,10 +50,9 @@ class Wikipedia:
         Returns:
             dict: The JSON response from the Wikipedia API.
         """
-        sorted_params = dict(sorted(params.items()))
-        sorted_headers = dict(sorted(Wikipedia.HEADERS.items()))
-        l.debug(f'Querying {Wikipedia.API_URL} with params: {sorted_params} and headers: {sorted_headers}')
-        response = self.session.get(Wikipedia.API_URL, params=sorted_params, headers=sorted_headers)
+        # CachedRequests normalizes the params and headers into its cache key
+        l.debug(f'Querying {Wikipedia.API_URL} with params: {params} and headers: {Wikipedia.HEADERS}')
+        response = self.session.get(Wikipedia.API_URL, params=params, headers=Wikipedia.HEADERS)
 
         if not response.ok:
             l.error(f'Error querying Wikipedia API: {response.status_code} - {response.text}')
@@ -249,7 +263,7 @@ class Wikipedia:
             return results
 
 
-    def get_wikicode(self, title: str) -> Wikicode:
+    def get_wikicode(self, title: str) -> 'Wikicode':
         """Get the wikicode for a given page title.
 
         Args:
@@ -267,6 +281,7 @@ class Wikipedia:
         response = self.query(params)
         page = response["query"]["pages"].popitem()[1]
         content: str = page["revisions"][0]["*"]
+        import_wikicode()
         return Wikicode.parse(content)
 
 
@@ -297,21 +312,22 @@ class Wikipedia:
         return url        
 
 
-    def get_pil_image(self, image_url: str, size: tuple[int, int] | None=None) -> Image:
+    def get_pil_image(self, image_url: str, size: tuple[int, int] | None=None) -> 'Image':
         """Get the image data for a given image title.
 
         Args:
             image_title (str): The title of the image.
             size (tuple[int, int] | None): The desired size of the image. If None, the original size is returned.
         """
-        from io import BytesIO
+        import PIL.Image
         PIL.Image.MAX_IMAGE_PIXELS = 500_000_000
         
         l.debug(f"Fetching image from URL: {image_url}")
-        response = self.session.get(image_url, headers=self.HEADERS)
+        # Streamed to a cache file and read through a memory map, so the encoded image is never copied into memory
+        response = self.session.get(image_url, headers=self.HEADERS, stream=True)
         response.raise_for_status()
-        data: bytes = response.content
-        image: Image = PIL.Image.open(BytesIO(data)).convert('RGB')
+        with response:
+            image: 'Image' = PIL.Image.open(response.raw).convert('RGB')
             
 
         if size is not None:
@@ -322,7 +338,7 @@ class Wikipedia:
         return image
     
 
-    def get_lead_image_pil(self, title: str, size: tuple[int, int] | None=None) -> Image | None:
+    def get_lead_image_pil(self, title: str, size: tuple[int, int] | None=None) -> 'Image | None':
         """Get the lead image for a given page title.
 
         Args:
@@ -0,0 +1,23 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    """A request handler that doesn't log every request to stderr."""
+
+    def log_message(self, *args):
+        pass
+
+
+@contextmanager
+def local_server(handler: type[BaseHTTPRequestHandler]):
+    """Serve a request handler on localhost for the duration of a test."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-from coolpy.args import parse_args, Arg
+from coolpy.args import parse_args, Arg, Command
+import enum
 import logging
 import typing as t
 
@@ -42,6 +43,63 @@ def test_args():
     print("Args test passed.")
 
 
+class Tool:
+    """A tool with subcommands"""
+    verbose: bool = Arg(help="Verbose output")
+
+    class build(Command):
+        """Build a target"""
+        target: str = Arg(help="What to build")
+        jobs: int = Arg(default=1, flags=["-j"])
+
+        @staticmethod
+        def main(args):
+            return f"building {args.target}"
+
+
+def test_subcommands():
+    import os
+    import sys
+    import tempfile
+
+    args = parse_args(Tool, argv=["--verbose", "build", "-j", "4", "docs"])
+    assert args.verbose is True
+    assert args.command == "build"
+    assert args.command_args.target == "docs"
+    assert args.command_args.jobs == 4
+    assert args.command_main(args.command_args) == "building docs"
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("lazy_tool_a", "lazy_tool_b"):
+            with open(os.path.join(directory, f"{name}.py"), "w") as f:
+                f.write("class Args:\n    count: int\n\ndef main(args):\n    return args.count * 2\n")
+        sys.path.insert(0, directory)
+        try:
+            subcommands = {"a": "lazy_tool_a", "b": "lazy_tool_b:Args"}
+            args = parse_args(Tool, subcommands=subcommands, argv=["b", "21"])
+            assert args.command_main(args.command_args) == 42
+            # Only the chosen command's module is imported
+            assert "lazy_tool_b" in sys.modules
+            assert "lazy_tool_a" not in sys.modules
+        finally:
+            sys.path.remove(directory)
+            sys.modules.pop("lazy_tool_b", None)
+
+    # Other nested classes aren't subcommands
+    args = parse_args(Painter, argv=["--color", "red"])
+    assert args.color == Painter.Color.red
+    assert not hasattr(args, "command")
+
+
+class Painter:
+    class Color(enum.Enum):
+        red = "red"
+        blue = "blue"
+
+    color: Color = Arg(default=Color.blue, flags=["--color"], choices=list(Color))
+
+
 if __name__ == "__main__":
     test_args()
+    test_subcommands()
     cli()
@@ -2,7 +2,9 @@
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
-from coolpy.caching import CachedRequests
+from coolpy.caching import CachedRequests, Cache, cached_function
+from conftest import QuietHandler, local_server
+
 
 def test_cached_requests():
     cached_requests = CachedRequests(expiration_days=1, throttle_seconds=0.1)
@@ -42,6 +44,556 @@ def test_function_caching():
     assert result2 == 3
 
 
+def test_cache_store():
+    import threading
+    from coolpy.caching import CacheStore, cached_function, delete_cache_entry
+
+    calls = []
+
+    @cached_function(name='test_cache_store')
+    def square(x: int) -> int:
+        calls.append(x)
+        return x * x
+
+    delete_cache_entry('test_cache_store', (3,), {})
+
+    # Every thread shares the same pooled store
+    threads = [threading.Thread(target=square, args=(3,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    store = CacheStore.get('test_cache_store')
+    assert store is CacheStore.get('test_cache_store')
+    assert store.conn.execute('pragma journal_mode').fetchone()[0] == 'wal'
+    assert square(3) == 9
+    assert len(calls) >= 1
+
+    store.flush()
+    assert store.pending_writes == 0
+
+
+class Scale:
+    def __init__(self, factor: int):
+        self.factor = factor
+
+    def apply(self, x: int) -> int:
+        return x * self.factor
+
+
+def test_cache_key():
+    from coolpy.caching import cache_key, KEY_SIZE
+
+    key = cache_key((1, {'b', 'a', 'c'}), {'x': 1, 'y': [1, 2]})
+    assert len(key) == KEY_SIZE
+    assert key == cache_key((1, {'c', 'a', 'b'}), {'y': [1, 2], 'x': 1})
+    assert key != cache_key((1, {'a', 'b'}), {'x': 1, 'y': [1, 2]})
+    assert cache_key((1, ), {}) != cache_key((1.0, ), {})
+    assert cache_key(('1', ), {}) != cache_key((1, ), {})
+
+    # Callables are told apart, or refused
+    import functools
+    assert cache_key((Scale(2).apply, ), {}) != cache_key((Scale(3).apply, ), {})
+    assert cache_key((functools.partial(pow, 2), ), {}) != cache_key((functools.partial(pow, 3), ), {})
+    assert cache_key((len, ), {}) != cache_key((abs, ), {})
+    try:
+        cache_key((lambda x: x, ), {})
+        assert False, 'lambdas have no stable key'
+    except Exception:
+        pass
+
+    # Plain data objects are keyed on their fields
+    assert cache_key((Scale(2), ), {}) == cache_key((Scale(2), ), {})
+    assert cache_key((Scale(2), ), {}) != cache_key((Scale(3), ), {})
+
+    # Self-referencing values
+    looped = [1]
+    looped.append(looped)
+    other = [1]
+    other.append(other)
+    assert cache_key((looped, ), {}) == cache_key((other, ), {})
+    assert cache_key((looped, ), {}) != cache_key(([1, [1]], ), {})
+
+
+def test_memory_cache():
+    from coolpy.caching import CacheStore, MemoryCache, cached_function, delete_cache_entry, cache_key
+
+    calls = []
+
+    @cached_function(name='test_memory_cache', memory_entries=2)
+    def double(x: int) -> list[int]:
+        calls.append(x)
+        return [x, x]
+
+    for x in range(3):
+        delete_cache_entry('test_memory_cache', (x,), {})
+
+    assert double(0) == [0, 0]
+    assert double(0) is double(0)  # served from memory, no unpickling
+
+    memory = CacheStore.get('test_memory_cache').memory
+    double(1)
+    double(2)
+    assert len(memory) == 2
+    assert memory.get(cache_key((0,), {})) is None  # least recently used was evicted
+
+    delete_cache_entry('test_memory_cache', (2,), {})
+    assert memory.get(cache_key((2,), {})) is None
+    double(2)
+    assert calls == [0, 1, 2, 2]
+
+    # Memory hits don't wait for the store lock, which commits and lease waits hold
+    import threading
+    import time
+    store = CacheStore.get('test_memory_cache')
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with store.lock:
+            holding.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    holding.wait(5)
+    start = time.monotonic()
+    assert double(2) == [2, 2]
+    assert time.monotonic() - start < 1
+    release.set()
+    holder.join()
+
+    # Values loaded from SQLite are charged the same pickled size as stored ones
+    delete_cache_entry('test_memory_cache', (3,), {})
+    memory.clear()
+    double(3)
+    stored_bytes = memory.total_bytes
+    memory.clear()
+    double(3)
+    assert memory.total_bytes == stored_bytes
+
+    lru = MemoryCache(max_entries=10, max_bytes=100)
+    lru.put(b'a', 'a', 0, 60)
+    lru.put(b'b', 'b', 0, 60)
+    assert lru.get(b'a') is None and lru.total_bytes == 60
+
+
+def test_async_cached_function():
+    import asyncio
+    from coolpy.caching import cached_function, is_cache_hit, delete_cache_entry
+
+    calls = []
+
+    async def slow_multiply(a: int, b: int) -> int:
+        calls.append((a, b))
+        await asyncio.sleep(0.1)
+        return a * b
+
+    fast_multiply = cached_function(name='test_async_cached_function')(slow_multiply)
+    is_hit = is_cache_hit(name='test_async_cached_function')(slow_multiply)
+
+    async def main():
+        delete_cache_entry('test_async_cached_function', (6, 7), {})
+        assert not await is_hit(6, 7)
+
+        # Concurrent awaits of the same key share one computation
+        results = await asyncio.gather(*[fast_multiply(6, 7) for _ in range(5)])
+        assert results == [42] * 5
+        assert calls == [(6, 7)]
+
+        assert await is_hit(6, 7)
+        assert await fast_multiply(6, 7) == 42
+        assert calls == [(6, 7)]
+
+    asyncio.run(main())
+
+
+def test_stampede_lease():
+    import socket
+    import subprocess
+    import sys
+    import threading
+    import time
+    from coolpy.caching import CacheStore, cached_function, delete_cache_entry, cache_key
+
+    calls = []
+
+    @cached_function(name='test_stampede_lease', stampede='wait', lease_timeout=10)
+    def slow_square(x: int) -> int:
+        calls.append(x)
+        time.sleep(0.3)
+        return x * x
+
+    delete_cache_entry('test_stampede_lease', (4,), {})
+
+    # Every thread has its own lease owner, just like separate processes
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow_square(4))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [16] * 4
+    assert calls == [4]
+
+    # A lease left behind by a dead process is taken over
+    store = CacheStore.get('test_stampede_lease')
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    key = cache_key((5,), {})
+    store.write('insert or replace into lease (key, owner, host, pid, expires) values (?, ?, ?, ?, ?)',
+                (key, 'crashed', socket.gethostname(), dead.pid, time.time() + 3600), commit=True)
+    assert store.acquire_lease(key, 60)
+    store.release_lease(key)
+
+
+def test_cache_limits():
+    import pickle
+    import time
+    from coolpy.caching import CacheStore, cached_function
+
+    @cached_function(name='test_cache_limits', max_entries=3)
+    def identity(x: int) -> int:
+        return x
+
+    store = CacheStore.get('test_cache_limits')
+    store.conn.execute('delete from cache')
+    store.conn.commit()
+
+    for x in range(3):
+        identity(x)
+    store.flush()
+
+    # Make 0 the most recently used entry, then overflow the cache
+    store.conn.execute('update cache set accessed = accessed - 10')
+    identity(0)
+    store.flush()
+    for x in range(3, 5):
+        identity(x)
+    store.flush()
+
+    entries, total_bytes = store.fetchone('select entries, bytes from cache_stats')
+    assert entries == 3
+    assert total_bytes == store.fetchone('select sum(size) from cache')[0]
+    remaining = {pickle.loads(row[0]) for row in store.fetchall('select args from cache')}
+    assert remaining == {(0,), (3,), (4,)}
+
+    # Expired rows are deleted a few at a time as part of later commits
+    store.conn.execute('update cache set timestamp = ?', (int(time.time()) - 10 ** 9, ))
+    store.write('delete from cache where 0')
+    store.flush()
+    assert store.fetchone('select count(*) from cache')[0] == 0
+
+
+def test_large_value_storage():
+    import os
+    from coolpy.caching import CacheStore, cached_function, delete_cache_entry, STORAGE_COMPRESSED, STORAGE_FILE
+
+    @cached_function(name='test_large_value_storage', compress_threshold=1024, file_threshold=64 * 1024)
+    def make_blob(size: int) -> bytes:
+        return b'x' * size
+
+    store = CacheStore.get('test_large_value_storage')
+    for size in (10_000, 1_000_000):
+        delete_cache_entry('test_large_value_storage', (size,), {})
+    store.flush()
+
+    assert make_blob(10_000) == make_blob(10_000)
+    assert make_blob(1_000_000) == make_blob(1_000_000)
+
+    storages = {row[0] for row in store.fetchall('select storage from cache')}
+    assert storages == {STORAGE_COMPRESSED, STORAGE_FILE}
+
+    digest = store.fetchone(f'select return_value from cache where storage = {STORAGE_FILE}')[0]
+    blob_path = store.blob_path(digest.decode())
+    assert os.path.exists(blob_path)
+
+    # Deleting the last row that refers to a blob file removes the file
+    delete_cache_entry('test_large_value_storage', (1_000_000,), {})
+    store.flush()
+    assert not os.path.exists(blob_path)
+
+
+def test_cached_response():
+    import pickle
+    import uuid
+    from coolpy.caching import CachedResponse
+
+    hits = []
+
+    class Handler(QuietHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            body = b'{"answer": 42}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('ETag', '"v1"')
+            self.send_header('X-Unneeded', 'dropped')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    with local_server(Handler) as url:
+        cached_requests = CachedRequests(expiration_days=1)
+        url = f'{url}/{uuid.uuid4()}'
+
+        response1 = cached_requests.get(url)
+        response2 = cached_requests.get(url)
+
+    assert len(hits) == 1
+    assert response2.status_code == 200
+    assert response2.json() == response1.json() == {'answer': 42}
+    assert response2.headers['etag'] == '"v1"'
+    assert 'X-Unneeded' not in response2.headers
+
+    record = CachedResponse.from_response(response1)
+    assert len(pickle.dumps(record)) < len(pickle.dumps(response1))
+
+
+def test_revalidation():
+    import uuid
+    from coolpy.caching import CacheStore, request_fingerprint
+
+    full_bodies = []
+
+    class Handler(QuietHandler):
+        def do_GET(self):
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+            full_bodies.append(self.path)
+            body = b'unchanged body'
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    with local_server(Handler) as url:
+        cached_requests = CachedRequests(expiration_days=1, revalidate=True)
+        url = f'{url}/{uuid.uuid4()}'
+
+        assert cached_requests.get(url).text == 'unchanged body'
+
+        # Expire the entry, it should be revalidated rather than downloaded again
+        store = CacheStore.get('cached_requests')
+        store.write('update cache set timestamp = timestamp - 2 * 24 * 60 * 60 where key = ?', (request_fingerprint(('GET', url), {}), ), commit=True)
+        assert not cached_requests.is_cache_hit('GET', url)
+
+        response = cached_requests.get(url)
+        assert response.status_code == 200
+        assert response.text == 'unchanged body'
+        assert cached_requests.is_cache_hit('GET', url)
+
+    assert len(full_bodies) == 1
+
+
+def test_request_many():
+    import time
+    import uuid
+    from coolpy.caching import TokenBucket
+
+    class Handler(QuietHandler):
+        def do_GET(self):
+            time.sleep(0.2)
+            body = self.path.encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    with local_server(Handler) as url:
+        cached_requests = CachedRequests(expiration_days=1, throttle_seconds=0.01, burst=10)
+        prefix = uuid.uuid4()
+        urls = [f'{url}/{prefix}/{i}' for i in range(10)]
+
+        cached_requests.get(urls[0])
+
+        start = time.monotonic()
+        responses = cached_requests.get_many(urls, max_workers=10)
+        elapsed = time.monotonic() - start
+
+    assert [response.text for response in responses] == [f'/{prefix}/{i}' for i in range(10)]
+    assert elapsed < 1.0  # 9 misses of 0.2s each ran concurrently
+
+    bucket = TokenBucket(rate=20, capacity=1)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert 0.15 < time.monotonic() - start < 0.5
+
+
+def test_cache_api():
+    from coolpy.caching import Cache
+
+    cache = Cache('test_cache_api', days=1)
+    key = Cache.key(('answer', ), {})
+    cache.invalidate(key)
+
+    result = cache.lookup(key)
+    assert not result.hit and result.value is None and result.age is None
+
+    computed = []
+    result = cache.get_or_compute(key, lambda: computed.append(1) or 42)
+    assert not result.hit and result.value == 42 and result.size > 0
+
+    result = cache.get_or_compute(key, lambda: computed.append(1) or 43)
+    assert result.hit and result.value == 42 and 0 <= result.age < 5
+    assert computed == [1]
+
+    # Expired values are only returned when asked for
+    cache.backend.write('update cache set timestamp = timestamp - 2 * 24 * 60 * 60 where key = ?', (key, ))
+    assert not cache.lookup(key).hit
+    stale = cache.lookup(key, allow_stale=True)
+    assert stale.stale and stale.value == 42
+
+    cache.invalidate(key)
+    assert not cache.contains(key)
+
+
+def test_request_fingerprint():
+    import uuid
+    from coolpy.caching import request_fingerprint
+
+    url = 'https://en.wikipedia.org/w/api.php'
+    key = request_fingerprint(('GET', url), {'params': {'a': 1, 'b': 'x'}, 'headers': {'User-Agent': 'one'}})
+    assert key == request_fingerprint(('get', 'HTTPS://en.wikipedia.org:443/w/api.php?b=x'), {'params': {'a': '1'}, 'headers': {'User-Agent': 'two'}, 'timeout': 5})
+    assert key != request_fingerprint(('GET', url), {'params': {'a': 2, 'b': 'x'}})
+    assert key != request_fingerprint(('GET', url), {'params': {'a': 1, 'b': 'x'}, 'headers': {'Accept-Language': 'fr'}})
+    assert request_fingerprint(('POST', url), {'json': {'x': 1, 'y': 2}}) == request_fingerprint(('POST', url), {'json': {'y': 2, 'x': 1}})
+    assert request_fingerprint(('POST', url), {'data': b'1'}) != request_fingerprint(('POST', url), {'data': b'2'})
+
+    # Headers that change the body, and credentials in the URL, are always part of the key
+    assert request_fingerprint(('GET', url), {}) != request_fingerprint(('GET', url), {'headers': {'Range': 'bytes=0-99'}})
+    assert request_fingerprint(('GET', url), {}, key_headers=()) != request_fingerprint(('GET', url), {'headers': {'Range': 'bytes=0-99'}}, key_headers=())
+    assert request_fingerprint(('GET', 'https://a:1@h/'), {}) != request_fingerprint(('GET', 'https://a:2@h/'), {})
+    assert request_fingerprint(('GET', 'https://a:1@h/'), {}) == request_fingerprint(('GET', 'https://a:1@H/'), {})
+
+    sent = []
+
+    class Handler(QuietHandler):
+        def do_GET(self):
+            sent.append(self.path)
+            body = b'ok'
+            self.send_response(200)
+            self.send_header('Vary', 'X-Variant')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    with local_server(Handler) as server_url:
+        cached_requests = CachedRequests(expiration_days=1, list_separator='|')
+        path = f'{server_url}/{uuid.uuid4()}'
+
+        cached_requests.get(path, params={'titles': ['A', 'B'], 'format': 'json'}, headers={'User-Agent': 'one'})
+        cached_requests.get(path, params={'format': 'json', 'titles': 'A|B'}, headers={'User-Agent': 'two'})
+        assert len(sent) == 1
+
+        # The response varies on a header that isn't part of the key
+        cached_requests.get(path, params={'format': 'json', 'titles': 'A|B'}, headers={'X-Variant': 'other'})
+        assert len(sent) == 2
+
+    # Cookies from the session's jar don't make responses that vary on Cookie uncacheable
+    cookie_sent = []
+
+    class CookieHandler(QuietHandler):
+        def do_GET(self):
+            cookie_sent.append(self.path)
+            body = b'ok'
+            self.send_response(200)
+            self.send_header('Set-Cookie', f'session={uuid.uuid4()}; Path=/')
+            self.send_header('Vary', 'Accept-Encoding,Cookie')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    with local_server(CookieHandler) as server_url:
+        cached_requests = CachedRequests(expiration_days=1)
+        paths = [f'{server_url}/{uuid.uuid4()}' for _ in range(2)]
+        for path in paths + paths + paths[:1]:
+            assert cached_requests.get(path).text == 'ok'
+        assert len(cookie_sent) == 2
+
+
+def test_streamed_download():
+    import mmap
+    import os
+    import uuid
+    from coolpy.caching import CacheStore
+
+    body = os.urandom(3 * 1024 * 1024 + 5)
+    sent = []
+
+    class Handler(QuietHandler):
+        def do_GET(self):
+            sent.append(self.path)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    with local_server(Handler) as server_url:
+        cached_requests = CachedRequests(expiration_days=1)
+        url = f'{server_url}/{uuid.uuid4()}'
+
+        # The body goes to a blob file, on a miss and on a hit it is read through a memory map
+        for _ in range(2):
+            with cached_requests.get(url, stream=True) as response:
+                assert isinstance(response.raw, mmap.mmap)
+                assert memoryview(response.raw) == body
+                assert response.raw.read(4) == body[:4]
+        assert len(sent) == 1
+
+        # Non-streamed requests share the entry
+        assert cached_requests.get(url).content == body
+        assert len(sent) == 1
+
+        # Deleting the entry deletes its body file
+        record = cached_requests.cached_request('GET', url)
+        store = CacheStore.get('cached_requests')
+        path = store.blob_path(record.body)
+        assert os.path.exists(path)
+        cached_requests.cache.invalidate(cached_requests.normalize(('GET', url), {})[2])
+        store.flush()
+        assert not os.path.exists(path)
+
+
+@cached_function('test_prefetch')
+def prefetched_square(x: int) -> int:
+    return x * x
+
+
+def test_prefetch():
+    prefetched_square.cache.backend.write('delete from cache', commit=True)
+    prefetched_square(3)
+
+    # 3 is already cached and 4 is asked for twice
+    assert prefetched_square.prefetch([1, 2, 3, 4, 4], progress=False) == 3
+    assert prefetched_square.cache.fresh_keys(Cache.key((x, ), {}) for x in range(6)) == {Cache.key((x, ), {}) for x in range(1, 5)}
+    assert prefetched_square.prefetch([(x, ) for x in range(1, 5)], progress=False) == 0
+
+    assert prefetched_square.prefetch(range(100), pool='process', max_workers=2, batch_size=16, progress=False) == 96
+    assert prefetched_square.cache.lookup(Cache.key((99, ), {})).value == 99 * 99
+
+
 if __name__ == '__main__':
     test_cached_requests()
     test_function_caching()
+    test_cache_store()
+    test_cache_key()
+    test_memory_cache()
+    test_async_cached_function()
+    test_stampede_lease()
+    test_cache_limits()
+    test_large_value_storage()
+    test_cached_response()
+    test_revalidation()
+    test_request_many()
+    test_cache_api()
+    test_request_fingerprint()
+    test_streamed_download()
+    test_prefetch()
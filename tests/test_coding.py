@@ -1,5 +1,6 @@
 import coolpy.coding as coding
 from dataclasses import dataclass
+from typing import Literal
 
 
 def test_coding():
@@ -30,6 +31,131 @@ def test_coding():
     print(coding.encode(test))
 
 
+@dataclass
+class Node:
+    name: str
+    weight: float = None
+    tags: list[str] = None
+    children: list['Node'] = None
+    parent_id: int | str | None = None
+
+
+def test_compiled_codecs():
+    from typing import Optional
+
+    tree = {'name': 'root', 'weight': 1, 'tags': ['a', 'b'], 'children': [{'name': 'leaf', 'parent_id': 'root'}]}
+    decoded = coding.decode(tree, Node)
+    assert decoded == Node('root', 1.0, ['a', 'b'], [Node('leaf', parent_id='root')])
+    assert type(decoded.weight) == float
+    assert coding.encode(decoded) == {'name': 'root', 'weight': 1.0, 'tags': ['a', 'b'], 'children': [{'name': 'leaf', 'parent_id': 'root'}]}
+
+    # The decoder is compiled once and reused
+    assert coding.decoder(Node) is coding.decoder(Node)
+    assert coding.decode_many([tree, {'name': 'other'}, None], Node) == [decoded, Node('other'), None]
+
+    assert coding.decode({'a': 1, 'b': None}, dict[str, int]) == {'a': 1, 'b': None}
+    assert coding.decode([1, 2], Optional[list[float]]) == [1.0, 2.0]
+
+    # Unions that differ only in order have their own decoders
+    assert type(coding.decode(1, int | float)) == int
+    assert type(coding.decode(1, float | int)) == float
+    assert [type(x) for x in coding.decode([1], list[float | int])] == [float]
+
+    try:
+        coding.decode(['x'], list[int])
+        assert False
+    except Exception:
+        pass
+
+
+def test_compact_classes():
+    from typing import NamedTuple
+
+    @dataclass(slots=True)
+    class Slotted:
+        a: int
+        b: list[str] = None
+
+    @dataclass(frozen=True)
+    class Frozen:
+        a: int
+        slotted: Slotted = None
+
+    class Point(NamedTuple):
+        x: int
+        frozen: Frozen | None = None
+
+    class Plain:
+        __slots__ = ('x', 'y')
+        x: int
+        y: str
+
+        def __init__(self, x: int = None, y: str = None):
+            self.x = x
+            self.y = y
+
+    point = Point(1, Frozen(2, Slotted(3, ['k'])))
+    encoded = coding.encode(point)
+    assert encoded == {'x': 1, 'frozen': {'a': 2, 'slotted': {'a': 3, 'b': ['k']}}}
+    assert coding.decode(encoded, Point) == point
+
+    plain = coding.decode(coding.encode(Plain(1)), Plain)
+    assert (plain.x, plain.y) == (1, None)
+
+
+@dataclass
+class Click:
+    kind: Literal['click']
+    x: int
+    y: int
+
+
+@dataclass
+class KeyPress:
+    kind: Literal['key']
+    key: str
+
+
+@dataclass
+class Scroll:
+    delta: float
+    events: list[Click | KeyPress] = None
+
+
+@dataclass
+class Resize:
+    width: int
+    height: int
+
+
+def test_discriminated_unions():
+    events = [{'kind': 'click', 'x': 1, 'y': 2}, {'kind': 'key', 'key': 'a'}]
+    assert coding.decode(events, list[Click | KeyPress]) == [Click('click', 1, 2), KeyPress('key', 'a')]
+
+    # Without a tag, the class is picked by its required keys
+    assert coding.decode({'delta': 1, 'events': events}, Scroll | Resize) == Scroll(1.0, [Click('click', 1, 2), KeyPress('key', 'a')])
+    assert coding.decode({'width': 1, 'height': 2}, Scroll | Resize | None) == Resize(1, 2)
+
+    # Primitives are picked by their JSON type
+    assert coding.decode(['a', 1, 2.5, True], list[bool | str | float]) == ['a', 1.0, 2.5, True]
+
+    # Decode errors are reported rather than swallowed
+    try:
+        coding.decode({'kind': 'click', 'x': 'one', 'y': 2}, Click | KeyPress)
+        assert False
+    except Exception as e:
+        assert 'one' in str(e)
+
+    try:
+        coding.decode({'kind': 'drag'}, Click | KeyPress)
+        assert False
+    except Exception as e:
+        assert 'drag' in str(e)
+
+
 if __name__ == "__main__":
     test_coding()
+    test_compiled_codecs()
+    test_compact_classes()
+    test_discriminated_unions()
 
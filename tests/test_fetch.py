@@ -0,0 +1,80 @@
+from coolpy.fetch import fetch, fetch_many, iter_body
+from conftest import QuietHandler, local_server
+import time
+
+
+class Handler(QuietHandler):
+    protocol_version = 'HTTP/1.1'
+    clients: set = set()
+
+    def do_GET(self):
+        Handler.clients.add(self.client_address)
+        if self.path == '/cookie':
+            body = (self.headers.get('Cookie') or '').encode()
+            self.send_response(200)
+            self.send_header('Set-Cookie', 'session=1; Path=/')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # /<delay in ms>
+        time.sleep(int(self.path.strip('/') or 0) / 1000)
+        body = self.path.encode() * 1000
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(201)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_fetch():
+    with local_server(Handler) as url:
+        Handler.clients.clear()
+        for _ in range(5):
+            assert fetch(f'{url}/0').content == b'/0' * 1000
+        # One kept-alive connection
+        assert len(Handler.clients) == 1
+
+        response = fetch(url, {'method': 'POST', 'body': b'hello', 'headers': {'Content-Type': 'text/plain'}})
+        assert response.status_code == 201
+        assert response.content == b'hello'
+
+        response = fetch(f'{url}/0', {'stream': True})
+        chunks = list(iter_body(response, chunk_size=100))
+        assert len(chunks) == 20
+        assert b''.join(chunks) == b'/0' * 1000
+
+        # Cookies aren't carried over between calls
+        assert fetch(f'{url}/cookie').content == b''
+        assert fetch(f'{url}/cookie').content == b''
+
+
+def test_fetch_many():
+    with local_server(Handler) as url:
+        delays = [300, 0, 200, 100]
+        requests = [f'{url}/{delay}' for delay in delays[:2]] + [(f'{url}/{delay}', {'method': 'GET'}) for delay in delays[2:]]
+
+        start = time.monotonic()
+        ordered = list(fetch_many(requests, concurrency=4))
+        assert time.monotonic() - start < 0.6
+        assert [index for index, _ in ordered] == [0, 1, 2, 3]
+        assert [response.content for _, response in ordered] == [f'/{delay}'.encode() * 1000 for delay in delays]
+
+        completed = [index for index, _ in fetch_many(requests, concurrency=4, ordered=False)]
+        assert completed == [1, 3, 2, 0]
+
+        failed = list(fetch_many(['http://127.0.0.1:1/', f'{url}/0'], return_exceptions=True))
+        assert isinstance(failed[0][1], Exception)
+        assert failed[1][1].status_code == 200
+
+
+if __name__ == '__main__':
+    test_fetch()
+    test_fetch_many()
@@ -0,0 +1,60 @@
+import subprocess
+import sys
+
+# Cumulative import time allowed for the modules short CLI tools start with
+IMPORT_BUDGET_MS = 50
+HEAVY_MODULES = ('requests', 'PIL', 'mwparserfromhell', 'sqlite3')
+
+
+def import_time_ms(module: str) -> float:
+    """Cumulative import time of a module in a fresh interpreter, from python -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000
+    raise AssertionError(f'No import time reported for {module}')
+
+
+def loaded_modules(module: str) -> set[str]:
+    code = f'import sys, {module}; print(" ".join(sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return set(result.stdout.split())
+
+
+def test_import_time():
+    for module in ('coolpy.args', 'coolpy.json'):
+        # The best of a few runs, to leave out a cold disk cache
+        elapsed = min(import_time_ms(module) for _ in range(3))
+        assert elapsed < IMPORT_BUDGET_MS, f'import {module} took {elapsed:.1f} ms'
+
+        heavy = {name for name in loaded_modules(module) if name.split('.')[0] in HEAVY_MODULES}
+        assert len(heavy) == 0, f'import {module} loaded {heavy}'
+
+
+def test_lazy_imports():
+    modules = loaded_modules('coolpy.wikipedia')
+    assert 'requests' not in modules
+    assert 'PIL' not in modules
+    assert 'mwparserfromhell' not in modules
+
+    modules = loaded_modules('coolpy.caching')
+    assert 'requests' not in modules
+
+    # The lazy names are still exported, and only those load requests
+    import coolpy.caching
+    import coolpy.caching.cached_requests
+    assert set(coolpy.caching.cached_requests.__all__) <= set(coolpy.caching.__all__)
+    namespace = {}
+    exec('from coolpy.caching import *', namespace)
+    assert 'CachedRequests' in namespace and 'CachedResponse' in namespace
+    try:
+        coolpy.caching.CachedRequest
+        assert False, 'misspelled names are not resolved'
+    except AttributeError:
+        pass
+
+
+if __name__ == '__main__':
+    test_import_time()
+    test_lazy_imports()
@@ -34,5 +34,97 @@ def test_json():
     assert loaded == test
     print("JSON test passed.")
 
+def test_iter_load():
+    import io
+    from dataclasses import dataclass
+
+    @dataclass
+    class Record:
+        id: int
+        values: list[float] = None
+
+    records = [Record(i, [i / 2] * (i % 4)) for i in range(1000)]
+
+    for lines in (True, False):
+        f = io.StringIO()
+        assert json.dump_iter(iter(records), f, lines=lines) == len(records)
+
+        # Small chunks split records and numbers across reads
+        for chunk_size in (5, 64 * 1024):
+            assert list(json.iter_load(io.StringIO(f.getvalue()), Record, chunk_size=chunk_size)) == records
+            assert list(json.iter_load(io.BytesIO(f.getvalue().encode()), Record, chunk_size=chunk_size)) == records
+
+    assert list(json.iter_load(io.StringIO('[1, 2]\n[3]\n'), list[int], lines=True)) == [[1, 2], [3]]
+
+    # A record much larger than a chunk takes a logarithmic number of reads
+    class CountingIO(io.StringIO):
+        reads = 0
+
+        def read(self, size=-1):
+            self.reads += 1
+            return super().read(size)
+
+    big = Record(0, [0.5] * 200_000)
+    f = CountingIO(json.dumps(big) + '\n' + json.dumps(Record(1)) + '\n')
+    assert list(json.iter_load(f, Record, chunk_size=16)) == [big, Record(1)]
+    assert f.reads < 40
+
+
+def test_json_file():
+    import os
+    import tempfile
+    import time
+    from dataclasses import dataclass, field
+
+    @dataclass
+    class Checkpoint:
+        done: list[int] = field(default_factory=list)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'checkpoint.json')
+
+        checkpoint = json.JSONFile(filename, Checkpoint)
+        checkpoint.contents.done.append(1)
+        assert checkpoint.write()
+        # Nothing changed, nothing written
+        assert not checkpoint.write()
+        assert json.JSONFile(filename, Checkpoint).contents.done == [1]
+
+        # Saves are batched until the interval passes or the block exits
+        with json.JSONFile(filename, Checkpoint, save_interval=60) as checkpoint:
+            for i in range(2, 100):
+                checkpoint.contents.done.append(i)
+                checkpoint.save()
+            assert json.JSONFile(filename, Checkpoint).contents.done == [1]
+        assert json.JSONFile(filename, Checkpoint).contents.done == list(range(1, 100))
+
+        checkpoint = json.JSONFile(filename, Checkpoint, save_interval=0.05)
+        checkpoint.contents.done.append(100)
+        checkpoint.save()
+        time.sleep(0.5)
+        assert json.JSONFile(filename, Checkpoint).contents.done == list(range(1, 101))
+        assert os.listdir(directory) == ['checkpoint.json']
+
+        # A corrupt file is not silently replaced
+        with open(filename, 'w') as f:
+            f.write('{"done": [1, 2')
+        try:
+            json.JSONFile(filename, Checkpoint)
+            assert False
+        except ValueError:
+            pass
+
+        # New files get the mode the umask allows
+        umask = os.umask(0o077)
+        try:
+            private = json.JSONFile(os.path.join(directory, 'private.json'), Checkpoint)
+            private.write()
+            assert os.stat(private.filename).st_mode & 0o777 == 0o600
+        finally:
+            os.umask(umask)
+
+
 if __name__ == "__main__":
     test_json()
+    test_iter_load()
+    test_json_file()
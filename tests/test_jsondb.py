@@ -1,10 +1,11 @@
 import coolpy.jsondb as jsondb
+import os
 import random
+import tempfile
 
 
 def test_jsondb():
     from dataclasses import dataclass
-    import os
 
     @dataclass
     class InnerClass:
@@ -20,10 +21,7 @@ def test_jsondb():
         e: set[str] = None
         f: InnerClass = None
 
-    db_path = "test_db.jsondb"
-    if os.path.exists(db_path):
-        os.remove(db_path)
-
+    db_path = os.path.join(tempfile.mkdtemp(), "test_db.jsondb")
     db = jsondb.JsonDB(db_path, TestClass)
 
     # Test inserting items
@@ -100,5 +98,64 @@ def test_jsondb():
 
     print("JSONDB test passed.")
 
+
+class Record:
+    index: int
+    tags: list[str]
+    point: dict[str, float]
+    name: str
+
+    def __init__(self, index: int = 0, tags: list[str] = None, point: dict[str, float] = None, name: str = None):
+        self.index = index
+        self.tags = tags
+        self.point = point
+        self.name = name
+
+
+def test_insert_many():
+    db_path = os.path.join(tempfile.mkdtemp(), "test_insert_many.jsondb")
+    db = jsondb.JsonDB(db_path, Record)
+    try:
+        # Indices that exist before the load are brought up to date after it
+        db.add_index("tags")
+        db.insert(Record(0, ["first"], {"x": 0.0}))
+
+        NUM_ITEMS = 25000
+        records = (Record(i, ["even" if i % 2 == 0 else "odd", f"t{i % 3}"], {"x": i / 2}, f"n{i}")
+                   for i in range(1, NUM_ITEMS + 1))
+        assert db.insert_many(records, chunk_size=1000) == NUM_ITEMS
+        assert db.insert_many([]) == 0
+
+        assert len(list(db.load_all())) == NUM_ITEMS + 1
+        assert len(db.query("tags", "first")) == 1
+        assert len(db.query("tags", "even")) == NUM_ITEMS // 2
+        assert len(db.query("tags", "t0")) == NUM_ITEMS // 3
+
+        # Indices created afterwards match the ones kept up to date by insert
+        assert [r.index for r in db.query("point.x", 1.5)] == [3]
+        assert [r.index for r in db.query("name", "n7")] == [7]
+        assert db.query("name", None) == []
+        with db.transaction():
+            db.insert(Record(NUM_ITEMS + 1, ["odd"], {"x": 1.5}))
+        assert sorted(r.index for r in db.query("point.x", 1.5)) == [3, NUM_ITEMS + 1]
+        assert len(db.query("tags", "odd")) == NUM_ITEMS // 2 + 1
+
+        # Errors reach the caller, and the load is rolled back
+        def failing():
+            yield Record(-1)
+            raise ValueError("bad record")
+
+        try:
+            db.insert_many(failing())
+            assert False
+        except ValueError:
+            pass
+        assert len(list(db.load_all())) == NUM_ITEMS + 2
+    finally:
+        del db
+        os.remove(db_path)
+
+
 if __name__ == "__main__":
     test_jsondb()
+    test_insert_many()
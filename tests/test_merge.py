@@ -36,5 +36,54 @@ def test_merge():
 
     print("Merge test passed.")
 
+def test_merge_strategies():
+    import time
+    from coolpy.merge import ByKey, REPLACE, UNION
+
+    parts = [{"items": [{"id": i % 100, "n": [i]}], "tags": ["a", "b"], "name": str(i)} for i in range(20000)]
+
+    start = time.monotonic()
+    merged = merge.merge(*parts, strategies={"items": ByKey("id"), "tags": UNION}, copy=True)
+    assert time.monotonic() - start < 5
+
+    assert len(merged["items"]) == 100
+    assert merged["items"][3]["n"] == list(range(3, 20000, 100))
+    assert merged["tags"] == ["a", "b"]
+    assert merged["name"] == "19999"
+
+    # Copy-on-write leaves the arguments alone and shares what didn't change
+    assert parts[0] == {"items": [{"id": 0, "n": [0]}], "tags": ["a", "b"], "name": "0"}
+    first, second = {"a": {"x": [1]}, "b": {"y": 1}}, {"a": {"x": [2]}}
+    merged = merge.merge(first, second, copy=True)
+    assert merged == {"a": {"x": [1, 2]}, "b": {"y": 1}}
+    assert first == {"a": {"x": [1]}, "b": {"y": 1}}
+    assert merged["b"] is first["b"]
+
+    # In place updates the first argument only
+    merged = merge.merge(first, second, strategies={list: REPLACE})
+    assert merged is first
+    assert first == {"a": {"x": [2]}, "b": {"y": 1}}
+    assert second == {"a": {"x": [2]}}
+
+    # An argument merged with itself
+    a = [1, 2]
+    assert merge.merge(a, a) == [1, 2, 1, 2]
+    nested = {"x": [1]}
+    assert merge.merge(nested, nested) == {"x": [1, 1]}
+
+    # Position by position
+    from coolpy.merge import MERGE
+    merged = merge.merge([{"a": 1}, {"b": 2}], [{"c": 3}], strategies={list: MERGE}, copy=True)
+    assert merged == [{"a": 1, "c": 3}, {"b": 2}]
+    assert merge.merge({1}, {2}, strategies={set: MERGE}) == {1, 2}
+
+    # Unhashable items are compared by value
+    merged = merge.merge([{"a": [1]}, [2]], [{"a": [1]}, [2], {"a": [3]}], strategies={list: UNION}, copy=True)
+    assert merged == [{"a": [1]}, [2], {"a": [3]}]
+    merged = merge.merge([{"id": {"k": 1}, "n": 1}], [{"id": {"k": 1}, "m": 2}], strategies={list: ByKey("id")})
+    assert merged == [{"id": {"k": 1}, "n": 1, "m": 2}]
+
+
 if __name__ == "__main__":
     test_merge()
+    test_merge_strategies()
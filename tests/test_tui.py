@@ -0,0 +1,37 @@
+from coolpy.tui import Progress, progress_bar
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import io
+
+
+def work(n: int) -> int:
+    progress_bar('process').update()
+    return n * n
+
+
+def test_progress():
+    stream = io.StringIO()
+
+    with Progress(stream=stream, log_interval=0.05) as progress:
+        threads = progress.add('threads', total=1000)
+        futures = progress.add('futures', total=20)
+        processes = progress.add('process', total=20)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda _: threads.update(), range(1000)))
+
+        with ProcessPoolExecutor(max_workers=2, **progress.pool_options()) as pool:
+            futures.track([pool.submit(work, n) for n in range(20)])
+
+    assert threads.completed() == 1000
+    assert futures.completed() == 20
+    assert processes.completed() == 20
+
+    # Not a terminal, so plain log lines
+    lines = stream.getvalue().splitlines()
+    assert '\033' not in stream.getvalue()
+    assert lines[-3].startswith('threads: [##############################] 100.0% (1000/1000)')
+    assert lines[-1].startswith('process: [##############################] 100.0% (20/20)')
+
+
+if __name__ == '__main__':
+    test_progress()